@@ -3,19 +3,31 @@ import threading
 import time
 import json
 import hashlib
+import re
+import difflib
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.managers import AcquirerProxy, BaseManager, BaseProxy
+from contextlib import contextmanager, nullcontext
+import fcntl
 from pathlib import Path
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 # from pyngrok import ngrok  # <-- RIMOSSO: Non necessario in un ambiente di produzione come Render.
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.generativeai import client as genai_client
 from google.api_core import exceptions
 import random
 # from kaggle_secrets import UserSecretsClient  # <-- RIMOSSO: I segreti non vengono più gestiti da Kaggle.
 from flask_cors import CORS
 import tempfile
 from datetime import datetime, timezone, timedelta
-from pydub import AudioSegment
 import io
 import subprocess
+import shutil
+import secrets
+import math
 
 # --- CONFIGURAZIONE ---
 # Il blocco di configurazione per NGROK e Kaggle è stato rimosso.
@@ -25,113 +37,145 @@ import subprocess
 app = Flask(__name__)
 CORS(app)
 
+# Con i worker gevent di gunicorn le chiamate gRPC a Gemini bloccherebbero l'intero hub per
+# tutta la loro durata: niente battito dei job in esecuzione, che dopo STALE_JOB_SECONDS
+# verrebbero rimessi in coda ed eseguiti due volte. gRPC va integrato con gevent prima
+# che venga creato qualsiasi canale.
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+if monkey is not None and monkey.is_module_patched("socket"):
+    from grpc.experimental import gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+
 # --- IMPORTANTE: Questo percorso viene mantenuto identico. ---
 # Su Render, creerai un "Persistent Disk" e lo monterai esattamente
 # su questo percorso. In questo modo, il codice non necessita di modifiche
 # e i tuoi file JSON saranno salvati in modo permanente.
-JOBS_DIR = Path("/kaggle/working/jobs")
+# La variabile JOBS_DIR serve solo per ambienti separati (es. i benchmark in benchmarks/).
+JOBS_DIR = Path(os.environ.get("JOBS_DIR", "/kaggle/working/jobs"))
 JOBS_DIR.mkdir(exist_ok=True, parents=True)
 
+# --- CONFIGURAZIONE CODA DEI JOB ---
+QUEUE_DIR = JOBS_DIR / "_queue"
+PENDING_DIR = QUEUE_DIR / "pending"
+RUNNING_DIR = QUEUE_DIR / "running"
+INCOMING_DIR = JOBS_DIR / "_incoming"
+for queue_subdir in (PENDING_DIR, RUNNING_DIR, INCOMING_DIR):
+    # Le voci in coda contengono la chiave API dell'utente: accesso riservato al processo.
+    queue_subdir.mkdir(exist_ok=True, parents=True, mode=0o700)
 
-# --- FUNZIONI HELPER ---
-# NESSUNA MODIFICA: Questa funzione è invariata.
-def get_user_hash(api_key):
-    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_WORKER_MODE = os.environ.get("JOB_WORKER_MODE", "thread")  # "thread" oppure "process"
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", "20"))
+QUEUE_POLL_SECONDS = 5
+HEARTBEAT_SECONDS = int(os.environ.get("HEARTBEAT_SECONDS", "30"))
+# Un job senza battito da così tanto tempo è considerato abbandonato e torna in coda. Il battito
+# gira in un thread del processo del worker: il valore deve superare il blocco più lungo che
+# questo thread può subire (con gevent, senza l'integrazione di gRPC, un'intera chiamata a Gemini).
+STALE_JOB_SECONDS = int(os.environ.get("STALE_JOB_SECONDS", "120"))
+# Dopo quanto tempo vengono eliminati i checkpoint e gli input dei job falliti e mai ripresi.
+CHECKPOINT_RETENTION_HOURS = int(os.environ.get("CHECKPOINT_RETENTION_HOURS", "72"))
+PURGE_INTERVAL_SECONDS = 3600
 
-# --- FUNZIONE DI ELABORAZIONE GEMINI ---
-# NESSUNA MODIFICA: La logica di elaborazione principale è rimasta assolutamente invariata.
-# La chiave API di Gemini (`api_key`) viene ancora passata per ogni singolo job,
-# preservando il modello "bring your own key" originale.
-def transcribe_and_summarize_task(lesson_id, user_hash, api_key, raw_input_path_str, subject, transcription_model_name, summary_model_name):
-    job_file = JOBS_DIR / user_hash / f"{lesson_id}.json"
-    print(f"[{lesson_id}] Inizio elaborazione per utente {user_hash[:8]}... (Trascrizione: {transcription_model_name}, Riassunto: {summary_model_name})")
-    
-    raw_input_file = Path(raw_input_path_str)
-    sanitized_temp_file = None
-    try:
-        # --- PASSAGGIO 1: RIPARAZIONE E STANDARDIZZAZIONE FILE-TO-FILE ---
-        print(f"[{lesson_id}] Avvio passaggio di riparazione da file a file...")
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_f:
-            sanitized_temp_file = Path(temp_f.name)
-
-        repair_command = [
-            'ffmpeg', '-y', '-analyzeduration', '20M', '-probesize', '20M',
-            '-i', str(raw_input_file),
-            '-vn', '-acodec', 'libmp3lame', '-b:a', '192k', '-f', 'mp3',
-            str(sanitized_temp_file)
-        ]
-        
-        result = subprocess.run(repair_command, capture_output=True, text=True, check=False)
-        
-        if result.returncode != 0:
-            print(f"ERRORE FFMPEG (Riparazione): {result.stderr}")
-            raise RuntimeError("Fase 1 fallita: impossibile riparare il file audio.")
+_queue_condition = threading.Condition()
+_owned_jobs = set()
+_owned_jobs_lock = threading.Lock()
+_workers_pid = None
+_workers_lock = threading.Lock()
 
-        # --- PASSAGGIO 2: CONTROLLO DI INTEGRITÀ ---
-        print(f"[{lesson_id}] File audio intermedio salvato. Avvio controllo di integrità...")
+# --- CONFIGURAZIONE UPLOAD A BLOCCHI ---
+# Ogni sessione di upload riprendibile ha una cartella con i metadati e i byte ricevuti finora.
+UPLOADS_DIR = JOBS_DIR / "_uploads"
+UPLOADS_DIR.mkdir(exist_ok=True, parents=True, mode=0o700)
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_MB", "1024")) * 1024 * 1024
+UPLOAD_COPY_BUFFER_BYTES = 1024 * 1024
+# Se attivo, ffmpeg converte l'audio mentre i byte arrivano, leggendo da una pipe.
+UPLOAD_STREAM_TRANSCODE = os.environ.get("UPLOAD_STREAM_TRANSCODE", "1") == "1"
+# Conversioni in streaming contemporanee per processo: oltre il limite l'audio viene convertito dal job.
+MAX_STREAM_TRANSCODES = int(os.environ.get("MAX_STREAM_TRANSCODES", "2"))
+# Sessioni di upload aperte (non ancora finalizzate) per chiave API.
+MAX_OPEN_UPLOADS_PER_USER = int(os.environ.get("MAX_OPEN_UPLOADS_PER_USER", "3"))
+# Il job attende la conversione in streaming finché questa avanza; se resta ferma per questo
+# tempo (es. il processo che la eseguiva è terminato) il job converte il file da sé.
+UPLOAD_STREAM_STALL_SECONDS = int(os.environ.get("UPLOAD_STREAM_STALL_SECONDS", "60"))
+# Oltre questo tempo senza nuovi byte la conversione in streaming viene abbandonata
+# (il client può comunque riprendere l'upload: la conversione avverrà nel job).
+UPLOAD_STREAM_IDLE_SECONDS = int(os.environ.get("UPLOAD_STREAM_IDLE_SECONDS", "300"))
+_upload_events = threading.Condition()
+_active_stream_transcodes = 0
+_stream_transcodes_lock = threading.Lock()
 
-        if not sanitized_temp_file.exists() or sanitized_temp_file.stat().st_size < 1024:
-            raise RuntimeError("Fase 2 fallita: il processo di riparazione ha generato un file vuoto o troppo piccolo.")
+# --- CONFIGURAZIONE CACHE ---
+# Sullo stesso disco persistente di JOBS_DIR: trascrizioni e riassunti già ottenuti vengono
+# riutilizzati quando la stessa registrazione (o lo stesso blocco) viene caricata di nuovo.
+CACHE_DIR = JOBS_DIR / "_cache"
+CACHE_DIR.mkdir(exist_ok=True, parents=True)
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "1") == "1"
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_MB", "512")) * 1024 * 1024
+CACHE_MAX_AGE_DAYS = int(os.environ.get("CACHE_MAX_AGE_DAYS", "30"))
 
-        probe_command = [
-            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1', str(sanitized_temp_file)
-        ]
-        
-        result = subprocess.run(probe_command, capture_output=True, text=True, check=False)
+MANIFESTS_DIR = JOBS_DIR / "_manifests"
+MANIFESTS_DIR.mkdir(exist_ok=True, parents=True)
+_manifest_lock = threading.Lock()
 
-        if result.returncode != 0:
-            print(f"ERRORE FFPROBE (Verifica): {result.stderr}")
-            raise RuntimeError("Fase 2 fallita: il file audio riparato è ancora illeggibile.")
-        
-        print(f"[{lesson_id}] Controllo di integrità superato. Durata rilevata: {result.stdout.strip()}s.")
-        
-        # La configurazione di Gemini avviene qui, usando la chiave specifica dell'utente per questo job.
-        # Comportamento INVARIATO.
-        genai.configure(api_key=api_key)
-        transcription_model = genai.GenerativeModel(transcription_model_name)
-        summary_model = genai.GenerativeModel(summary_model_name)
-
-        # --- PASSAGGIO 3: TRASCRIZIONE A BLOCCHI ---
-        print(f"[{lesson_id}] Divisione del file audio MP3 in blocchi...")
-        
-        audio = AudioSegment.from_file(sanitized_temp_file, format="mp3")
-
-        CHUNK_LENGTH_MS = 15 * 60 * 1000
-        transcripts = []
-        total_chunks = (len(audio) // CHUNK_LENGTH_MS) + (1 if len(audio) % CHUNK_LENGTH_MS > 0 else 0)
-
-        for i in range(total_chunks):
-            start_ms = i * CHUNK_LENGTH_MS
-            end_ms = start_ms + CHUNK_LENGTH_MS
-            chunk = audio[start_ms:end_ms]
-            
-            current_chunk_index = i + 1
-            print(f"[{lesson_id}] Elaborazione blocco {current_chunk_index}/{total_chunks}...")
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_chunk_file:
-                chunk.export(temp_chunk_file.name, format="mp3")
-                temp_chunk_path = Path(temp_chunk_file.name)
-
-            audio_file_resource = None
-            try:
-                response = None
-                max_retries = 10
-                for attempt in range(max_retries):
-                    try:
-                        print(f"[{lesson_id}] Caricamento blocco {current_chunk_index} a Gemini (Tentativo {attempt + 1})...")
-                        audio_file_resource = genai.upload_file(path=temp_chunk_path, mime_type="audio/mpeg")
-
-                        while audio_file_resource.state.name == "PROCESSING":
-                            time.sleep(10)
-                            audio_file_resource = genai.get_file(audio_file_resource.name)
-
-                        if audio_file_resource.state.name == "FAILED":
-                            raise ValueError("Elaborazione blocco audio fallita su Gemini.")
-                        
-                        if not transcripts:
-                            prompt = """Sei un assistente IA specializzato nella trascrizione di lezioni accademiche, incaricato di produrre un testo fedele e leggibile. Il tuo obiettivo è una trascrizione completa che subisce solo una leggerissima revisione stilistica.
+# Stream degli eventi dei job: intervallo del controllo dei file e del messaggio di keep-alive.
+EVENTS_POLL_SECONDS = 1
+EVENTS_KEEPALIVE_SECONDS = 15
+_job_events = threading.Condition()
+
+# --- CONFIGURAZIONE TRASCRIZIONE ---
+CHUNK_LENGTH_MS = 15 * 60 * 1000
+# In modalità parallela ogni blocco (tranne il primo) inizia qualche secondo prima,
+# così le frasi a cavallo del taglio compaiono intere in almeno uno dei due blocchi.
+CHUNK_OVERLAP_MS = int(os.environ.get("CHUNK_OVERLAP_SECONDS", "20")) * 1000
+# Limite di blocchi trascritti contemporaneamente con la stessa chiave API, condiviso tra tutti i job.
+MAX_PARALLEL_CHUNKS_PER_KEY = int(os.environ.get("MAX_PARALLEL_CHUNKS_PER_KEY", "3"))
+TRANSCRIPTION_MODES = ("parallel", "serial")
+# Formato dell'audio inviato a Gemini: mono a 16 kHz è sufficiente per il parlato
+# e produce blocchi molto più piccoli da caricare rispetto a un MP3 stereo a 192k.
+SPEECH_SAMPLE_RATE = os.environ.get("SPEECH_SAMPLE_RATE", "16000")
+SPEECH_BITRATE = os.environ.get("SPEECH_BITRATE", "32k")
+DEFAULT_TRANSCRIPTION_MODE = os.environ.get("TRANSCRIPTION_MODE", "parallel")
+
+# Riassunto: "single" invia l'intera trascrizione in un'unica chiamata, "map_reduce" riassume
+# le sezioni man mano che i blocchi sono trascritti e poi unisce le sintesi.
+SUMMARY_MODES = ("single", "map_reduce")
+DEFAULT_SUMMARY_MODE = os.environ.get("SUMMARY_MODE", "map_reduce")
+MAX_PARALLEL_SECTION_SUMMARIES = int(os.environ.get("MAX_PARALLEL_SECTION_SUMMARIES", "2"))
+# Dimensione delle sezioni quando vanno ricavate dalla trascrizione assemblata (circa 15 minuti di parlato).
+SECTION_TARGET_CHARS = 12000
+
+# Parametri della ricucitura: finestra di parole confrontata ai bordi e lunghezza minima della corrispondenza.
+STITCH_WINDOW_WORDS = 150
+STITCH_MIN_MATCH_WORDS = 4
+
+_key_semaphores = {}
+_key_semaphores_lock = threading.Lock()
+
+# --- CONFIGURAZIONE LIMITATORE GEMINI (per chiave API, condiviso tra tutti i job del worker) ---
+GEMINI_REQUESTS_PER_MINUTE = float(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "15"))
+GEMINI_BURST = int(os.environ.get("GEMINI_BURST", "5"))
+GEMINI_MAX_CONCURRENT_REQUESTS = int(os.environ.get("GEMINI_MAX_CONCURRENT_REQUESTS", "4"))
+RATE_LIMIT_BASE_BACKOFF_SECONDS = 5
+RATE_LIMIT_MAX_BACKOFF_SECONDS = 300
+
+# Sotto questa dimensione un blocco viene inviato come audio inline nella richiesta, evitando la File API.
+# Gemini accetta richieste fino a 20 MB in totale, prompt compreso.
+INLINE_AUDIO_MAX_BYTES = int(float(os.environ.get("INLINE_AUDIO_MAX_MB", "12")) * 1024 * 1024)
+FILE_POLL_INITIAL_SECONDS = 1
+FILE_POLL_MAX_SECONDS = 10
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+# Con JOB_WORKER_MODE=process: nel worker il manager che custodisce limitatori e semafori,
+# nei processi figli dei job la connessione a quel manager.
+_shared_limits_server = None
+_shared_limits = None
+
+# --- PROMPT DI TRASCRIZIONE ---
+TRANSCRIPTION_PROMPT = """Sei un assistente IA specializzato nella trascrizione di lezioni accademiche, incaricato di produrre un testo fedele e leggibile. Il tuo obiettivo è una trascrizione completa che subisce solo una leggerissima revisione stilistica.
 
 **Regole Fondamentali:**
 1.  **Trascrizione Completa (Priorità Massima):** Trascrivi **ogni parola** pronunciata dal docente. Non omettere frasi, concetti o esempi. Le ripetizioni di concetti o intere frasi sono importanti e **devono essere mantenute** perché fanno parte dello stile espositivo. L'output **non è un riassunto**.
@@ -146,9 +190,8 @@ def transcribe_and_summarize_task(lesson_id, user_hash, api_key, raw_input_path_
     * Usa una punteggiatura accurata e suddividi il testo in paragrafi logici.
     * Formatta le formule matematiche usando la sintassi LaTeX (es. $E=mc^2$).
 5.  **Output Diretto:** Restituisci **solo ed esclusivamente** il testo della trascrizione. Nessuna introduzione, nessun commento."""
-                        else:
-                            previous_context = transcripts[-1][-250:]
-                            prompt = f"""Stai continuando una trascrizione accademica. Il tuo compito è trascrivere il nuovo segmento audio, collegandoti in modo fluido al contesto fornito e seguendo le stesse regole del prompt iniziale.
+
+CONTINUATION_PROMPT_TEMPLATE = """Stai continuando una trascrizione accademica. Il tuo compito è trascrivere il nuovo segmento audio, collegandoti in modo fluido al contesto fornito e seguendo le stesse regole del prompt iniziale.
 
 **CONTESTO (ULTIMA PARTE DELLA TRASCRIZIONE PRECEDENTE - NON RIPETERLO):**
 ---
@@ -160,35 +203,21 @@ def transcribe_and_summarize_task(lesson_id, user_hash, api_key, raw_input_path_
 2. **Stile:** Mantieni la stessa revisione leggera (rimuovi 'ehm', 'uhm', ecc.). Non includere timestamp.
 3. **Output Diretto:** Restituisci solo il testo della nuova trascrizione, senza commenti o introduzioni."""
 
-                        response = transcription_model.generate_content([prompt, audio_file_resource], request_options={'timeout': 1800})
-                        break 
-                    except exceptions.ResourceExhausted as e:
-                        wait_time = (2 ** attempt) * 5 + random.uniform(0, 1)
-                        print(f"[{lesson_id}] Rate limit superato per trascrizione (tentativo {attempt + 1}/{max_retries}). Dettagli API: {e}. Attendo {wait_time:.1f}s...")
-                        time.sleep(wait_time)
-                    except Exception as e:
-                        print(f"[{lesson_id}] Errore API imprevisto durante la trascrizione: {e}")
-                        raise
-                
-                if response is None:
-                    raise RuntimeError(f"Impossibile ottenere la trascrizione dopo {max_retries} tentativi.")
-                
-                transcripts.append(response.text)
-                print(f"[{lesson_id}] Trascrizione blocco {current_chunk_index} completata.")
-
-            finally:
-                if temp_chunk_path and temp_chunk_path.exists(): temp_chunk_path.unlink()
-                if audio_file_resource:
-                    try:
-                        genai.delete_file(audio_file_resource.name)
-                    except Exception as delete_error:
-                        print(f"[{lesson_id}] Attenzione: impossibile eliminare file del blocco da Gemini. Errore: {delete_error}")
-            
-        transcript = " ".join(transcripts).strip()
-        print(f"[{lesson_id}] Trascrizione completa assemblata.")
-        
-        # --- 4 & 5. RIASSUNTO E ARGOMENTO (UNIFICATI IN UNA CHIAMATA) ---
-        unified_prompt = f"""Sei un assistente IA esperto nella redazione di testi accademici per la materia di {subject}. Il tuo compito è trasformare la trascrizione di una lezione in una sintesi didattica che sia al contempo **esaustiva nel contenuto e impeccabile nella struttura**. Devi eseguire due compiti e restituire il risultato come un singolo oggetto JSON.
+# Usato in modalità parallela per tutti i blocchi successivi al primo: il modello non
+# conosce il testo precedente, quindi deve trascrivere anche le frasi spezzate all'inizio
+# e alla fine del segmento. Le parti duplicate dalla sovrapposizione vengono rimosse dopo.
+PARALLEL_SEGMENT_PROMPT = TRANSCRIPTION_PROMPT + """
+
+**NOTA SUL SEGMENTO:** Questo audio è un segmento intermedio di una lezione più lunga e può iniziare o terminare a metà frase. Trascrivi anche le parole iniziali e finali, senza aggiungere collegamenti o commenti."""
+
+# Impronta dei prompt di trascrizione: se cambiano, le trascrizioni in cache non vengono più riutilizzate.
+TRANSCRIPTION_PROMPTS_SHA256 = hashlib.sha256(
+    (TRANSCRIPTION_PROMPT + CONTINUATION_PROMPT_TEMPLATE + PARALLEL_SEGMENT_PROMPT).encode('utf-8')
+).hexdigest()
+
+
+# --- PROMPT DI RIASSUNTO ---
+UNIFIED_SUMMARY_PROMPT_TEMPLATE = """Sei un assistente IA esperto nella redazione di testi accademici per la materia di {subject}. Il tuo compito è trasformare la trascrizione di una lezione in una sintesi didattica che sia al contempo **esaustiva nel contenuto e impeccabile nella struttura**. Devi eseguire due compiti e restituire il risultato come un singolo oggetto JSON.
 
 **REGOLA FONDAMENTALE: Massima Fedeltà alla Trascrizione**
 La tua intera elaborazione deve basarsi **ESCLUSIVAMENTE** sul contenuto della trascrizione fornita. **NON DEVI** usare conoscenza esterna. L'obiettivo è valorizzare e strutturare il materiale esistente al suo massimo potenziale, non integrarlo con informazioni nuove.
@@ -220,103 +249,1818 @@ La tua intera elaborazione deve basarsi **ESCLUSIVAMENTE** sul contenuto della t
 {transcript}
 ---
 """
-        unified_response = None
-        max_retries = 3
-        generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
+
+
+SECTION_SUMMARY_PROMPT_TEMPLATE = """Sei un assistente IA esperto nella redazione di testi accademici per la materia di {subject}. Ti viene fornita la trascrizione della parte {index} di {total} di una lezione. Il tuo compito è produrre una sintesi didattica di **questa sola parte**, che verrà poi unita a quelle delle altre parti.
+
+**REGOLE:**
+*   **Massima Fedeltà:** Basati **ESCLUSIVAMENTE** sul contenuto della trascrizione fornita, senza usare conoscenza esterna.
+*   **Completezza:** Includi **TUTTI** i concetti, le definizioni, gli esempi, le analogie e le spiegazioni presenti. Non semplificare e non omettere nulla per brevità.
+*   **Struttura:** Organizza il contenuto con titoli, sottotitoli ed elenchi puntati in Markdown, con stile formale e preciso.
+*   **Formule:** Usa la sintassi LaTeX per tutte le formule, espressioni, simboli matematici e cariche ioniche.
+*   **Bordi della Sezione:** La trascrizione può iniziare o terminare a metà frase e sovrapporsi leggermente alle parti adiacenti: non segnalarlo e non inventare collegamenti.
+*   **Output Diretto:** Restituisci solo il testo della sintesi, senza introduzioni o commenti.
+
+**Trascrizione della parte {index} di {total}:**
+---
+{transcript}
+---
+"""
+
+MERGE_SUMMARY_PROMPT_TEMPLATE = """Sei un assistente IA esperto nella redazione di testi accademici per la materia di {subject}. Ti vengono fornite, in ordine, le sintesi dettagliate delle {total} parti consecutive di una lezione. Devi eseguire due compiti e restituire il risultato come un singolo oggetto JSON.
+
+**REGOLA FONDAMENTALE: Massima Fedeltà alle Sintesi**
+La tua elaborazione deve basarsi **ESCLUSIVAMENTE** sul contenuto delle sintesi fornite. **NON DEVI** usare conoscenza esterna.
+
+**COMPITI:**
+1.  **Unire le Sintesi in un Unico Testo Esaustivo:**
+    *   **Completezza Assoluta (Priorità #1):** Mantieni **TUTTI** i concetti, le definizioni, gli esempi e le spiegazioni presenti nelle sintesi delle parti. Non operare semplificazioni o omissioni per brevità.
+    *   **Riorganizzazione Logica (Priorità #2):** Unisci le parti in un'unica struttura gerarchica chiara (titoli, sottotitoli, elenchi puntati), eliminando le ripetizioni dovute alla sovrapposizione tra parti consecutive e rendendo espliciti i collegamenti tra argomenti trattati in parti diverse.
+    *   **Formattazione:** Usa la sintassi Markdown standard e la sintassi LaTeX per **tutte** le formule, espressioni, simboli matematici e cariche ioniche.
+
+2.  **Generare un Titolo (Argomento) per la Lezione:**
+    *   Il titolo deve essere conciso, accademico e descrittivo, composto da un massimo di 5-7 parole, riflettendo l'intero contenuto della lezione.
+
+**ISTRUZIONI DI OUTPUT:**
+- Restituisci **ESCLUSIVAMENTE** un oggetto JSON valido. Non includere testo introduttivo, spiegazioni o ```json...```.
+- L'oggetto JSON deve avere due chiavi: `summary` (stringa) e `suggestedTopic` (stringa).
+
+**Sintesi delle parti della lezione:**
+---
+{sections}
+---
+"""
+
+
+# --- METRICHE ---
+# Registro in memoria esposto in formato testo Prometheus su /metrics. Ogni processo ha il
+# proprio registro (come il client Prometheus standard): con più worker gunicorn ogni
+# processo espone i propri contatori. Nei worker della coda in modalità "process" le metriche
+# raccolte dal figlio vengono restituite al padre alla fine di ogni job.
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+class MetricsRegistry:
+    """Contatori e istogrammi con etichette, protetti da un lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, help_text):
+        self._descriptions[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def drain(self):
+        """Restituisce i valori raccolti finora e azzera il registro."""
+        with self._lock:
+            snapshot = {"counters": self._counters, "histograms": self._histograms}
+            self._counters, self._histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self._lock:
+            for key, value in snapshot["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in snapshot["histograms"].items():
+                histogram = self._histograms.setdefault(key, {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0})
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    def render(self, gauges=()):
+        """Testo Prometheus (formato 0.0.4). `gauges` sono tuple (nome, etichette, valore) calcolate al momento."""
+        def format_labels(labels):
+            if not labels:
+                return ""
+            parts = []
+            for key, value in labels:
+                value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                parts.append(f'{key}="{value}"')
+            return "{" + ",".join(parts) + "}"
+
+        with self._lock:
+            samples = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                lines = samples.setdefault(name, [])
+                for bound, bucket_count in zip(METRICS_BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+
+        output = []
+        for name in sorted(set(samples) | set(self._descriptions)):
+            kind, help_text = self._descriptions.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples.get(name, []))
+        return "\n".join(output) + "\n"
+
+METRICS = MetricsRegistry()
+METRICS.describe("lecture_stage_seconds", "histogram", "Durata dei passaggi dell'elaborazione di una lezione.")
+METRICS.describe("gemini_request_seconds", "histogram", "Durata delle chiamate a Gemini per operazione (attesa del limitatore esclusa).")
+METRICS.describe("gemini_limiter_wait_seconds", "histogram", "Attesa nel limitatore per chiave prima di una chiamata a Gemini.")
+METRICS.describe("gemini_rate_limited_total", "counter", "Risposte 429 (ResourceExhausted) ricevute da Gemini.")
+METRICS.describe("gemini_retries_total", "counter", "Nuovi tentativi dopo un 429, per passaggio.")
+METRICS.describe("gemini_upload_bytes_total", "counter", "Byte di audio inviati a Gemini, per modalità di invio.")
+METRICS.describe("upload_received_bytes_total", "counter", "Byte di audio ricevuti dai client.")
+METRICS.describe("cache_lookups_total", "counter", "Ricerche nella cache di trascrizioni e riassunti.")
+METRICS.describe("jobs_finished_total", "counter", "Job terminati, per stato finale.")
+METRICS.describe("http_request_seconds", "histogram", "Durata delle richieste HTTP per endpoint, metodo e stato.")
+METRICS.describe("job_queue_depth", "gauge", "Job in coda o in esecuzione.")
+METRICS.describe("upload_sessions_open", "gauge", "Sessioni di upload a blocchi non ancora finalizzate.")
+
+# Passaggi che producono l'audio sanitizzato, salvati nel checkpoint insieme alla durata.
+AUDIO_STAGES = ("stream_transcode", "finalize_wait", "ffmpeg_repair", "ffprobe")
+
+@contextmanager
+def timed_stage(timings, stage):
+    # Registra la durata del passaggio nell'istogramma e, se presente, nei tempi del job.
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started_at
+        METRICS.observe("lecture_stage_seconds", elapsed, stage=stage)
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0) + elapsed, 3)
+
+# --- CLIENT GEMINI E LIMITAZIONE DELLE RICHIESTE ---
+class AdaptiveRateLimiter:
+    """Token bucket con tetto di concorrenza, condiviso da tutti i job di una stessa chiave API.
+
+    Ogni 429 dimezza la velocità e blocca tutte le chiamate della chiave per un intervallo
+    che raddoppia a ogni errore consecutivo; ogni successo riporta gradualmente la
+    velocità verso il massimo configurato.
+
+    Ogni chiamata porta la generazione del limitatore in cui è partita: un evento di quota
+    visto da più chiamate in volo fa scattare il rallentamento una sola volta, e solo le
+    chiamate partite dopo l'ultimo 429 contano come segnale di ripresa.
+    """
+
+    def __init__(self, requests_per_minute, burst, max_concurrency):
+        self.max_rate = requests_per_minute / 60
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def _acquire_token(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                wait_time = self.blocked_until - now
+                if wait_time <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return self.generation
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def acquire(self):
+        """Attende un posto e un token e restituisce la generazione corrente; va seguita da release()."""
+        self._slots.acquire()
+        try:
+            return self._acquire_token()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self):
+        self._slots.release()
+
+    @contextmanager
+    def slot(self):
+        """Attende un posto e un token; restituisce la generazione da passare a on_success/on_rate_limited."""
+        generation = self.acquire()
+        try:
+            yield generation
+        finally:
+            self.release()
+
+    def on_success(self, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self.backoff = 0.0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def on_rate_limited(self, generation):
+        with self._lock:
+            if generation == self.generation:
+                # Primo 429 di questo evento: rallenta e apre una nuova generazione.
+                self.generation += 1
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+                self.backoff = min(RATE_LIMIT_MAX_BACKOFF_SECONDS, max(RATE_LIMIT_BASE_BACKOFF_SECONDS, self.backoff * 2))
+                self.blocked_until = max(self.blocked_until, time.monotonic() + self.backoff + random.uniform(0, 1))
+            return max(0.0, self.blocked_until - time.monotonic())
+
+def get_rate_limiter(user_hash):
+    with _rate_limiters_lock:
+        if user_hash not in _rate_limiters:
+            if _shared_limits is not None:
+                _rate_limiters[user_hash] = _shared_limits.rate_limiter(user_hash)
+            else:
+                _rate_limiters[user_hash] = AdaptiveRateLimiter(GEMINI_REQUESTS_PER_MINUTE, GEMINI_BURST, GEMINI_MAX_CONCURRENT_REQUESTS)
+        return _rate_limiters[user_hash]
+
+class GeminiClient:
+    """Client Gemini legato a una singola chiave API, senza toccare la configurazione globale di `genai`.
+
+    Caricamenti e generazioni passano dal limitatore condiviso della chiave. Il client tiene
+    anche il conteggio e la durata totale delle chiamate per operazione, riportati nel job.
+    """
+
+    def __init__(self, api_key, limiter):
+        client_options = {"api_key": api_key}
+        self.limiter = limiter
+        self._file_client = genai_client.FileServiceClient(client_options=client_options)
+        self._generative_client = glm.GenerativeServiceClient(client_options=client_options)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def model(self, model_name):
+        model = genai.GenerativeModel(model_name)
+        # GenerativeModel crea il client predefinito solo se non ne ha già uno.
+        model._client = self._generative_client
+        return model
+
+    def record(self, operation, elapsed):
+        with self._stats_lock:
+            stats = self._stats.setdefault(operation, {"count": 0, "seconds": 0.0})
+            stats["count"] += 1
+            stats["seconds"] += elapsed
+
+    def stats(self):
+        with self._stats_lock:
+            return {operation: {"count": s["count"], "seconds": round(s["seconds"], 3)} for operation, s in self._stats.items()}
+
+    @contextmanager
+    def timed(self, operation):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started_at
+            METRICS.observe("gemini_request_seconds", elapsed, operation=operation)
+            self.record(operation, elapsed)
+
+    def _limited(self, operation, call, *args, **kwargs):
+        queued_at = time.monotonic()
+        with self.limiter.slot() as generation:
+            limiter_wait = time.monotonic() - queued_at
+            METRICS.observe("gemini_limiter_wait_seconds", limiter_wait)
+            self.record("limiter_wait", limiter_wait)
+            try:
+                with self.timed(operation):
+                    result = call(*args, **kwargs)
+            except exceptions.ResourceExhausted:
+                METRICS.inc("gemini_rate_limited_total", operation=operation)
+                backoff = self.limiter.on_rate_limited(generation)
+                print(f"Limitatore: 429 ricevuto, chiamate sospese per {backoff:.0f}s per questa chiave.")
+                raise
+        self.limiter.on_success(generation)
+        return result
+
+    def upload_file(self, path, mime_type):
+        path = Path(path)
+        METRICS.inc("gemini_upload_bytes_total", path.stat().st_size, method="file_api")
+        return genai.types.File(self._limited("upload_file", self._file_client.create_file, path=path, mime_type=mime_type, display_name=path.name))
+
+    def get_file(self, name):
+        with self.timed("get_file"):
+            return genai.types.File(self._file_client.get_file(name=name))
+
+    def delete_file(self, name):
+        with self.timed("delete_file"):
+            self._file_client.delete_file(request=genai.protos.DeleteFileRequest(name=name))
+
+    def generate_content(self, model, contents, **kwargs):
+        return self._limited("generate_content", model.generate_content, contents, **kwargs)
+
+# --- FUNZIONI HELPER ---
+# NESSUNA MODIFICA: Questa funzione è invariata.
+def get_user_hash(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def write_text_atomic(path, text):
+    # File temporaneo unico per ogni scrittura: più scrittori dello stesso file (es. due job
+    # che salvano la stessa voce di cache) non si contendono lo stesso nome.
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_name, path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+
+def write_json_atomic(path, data):
+    write_text_atomic(path, json.dumps(data))
+
+# --- MANIFEST DEI JOB PER UTENTE ---
+# Per ogni utente, MANIFESTS_DIR/<user_hash>.json associa ogni lesson_id a stato, data e
+# dimensione del file del job, più un numero di sequenza crescente. Ogni cambio di stato
+# passa da write_job_state, che aggiorna file del job e manifest sotto lo stesso lock:
+# /sync può così restituire solo i job cambiati dopo un cursore senza aprire gli altri file.
+@contextmanager
+def _locked_manifest(user_hash):
+    # Il lock di thread precede flock: con gevent un flock bloccante fermerebbe l'intero processo.
+    with _manifest_lock, open(MANIFESTS_DIR / f"{user_hash}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield _load_manifest(user_hash)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _load_manifest(user_hash):
+    try:
+        with open(MANIFESTS_DIR / f"{user_hash}.json", 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return _build_manifest(user_hash)
+
+def _build_manifest(user_hash):
+    # Ricostruzione una tantum per gli utenti con job creati prima del manifest.
+    manifest = {"seq": 0, "jobs": {}}
+    user_dir = JOBS_DIR / user_hash
+    if not user_dir.exists():
+        return manifest
+    for job_file in sorted(user_dir.glob("*.json"), key=lambda p: p.stat().st_mtime):
+        try:
+            with open(job_file, 'r') as f:
+                status = json.load(f).get("status")
+        except (OSError, json.JSONDecodeError):
+            print(f"Attenzione: file job corrotto durante la ricostruzione del manifest: {job_file}")
+            continue
+        manifest["seq"] += 1
+        manifest["jobs"][job_file.stem] = _manifest_entry(job_file, status, manifest["seq"])
+    print(f"Manifest ricostruito per {user_hash[:8]}: {len(manifest['jobs'])} job.")
+    write_json_atomic(MANIFESTS_DIR / f"{user_hash}.json", manifest)
+    return manifest
+
+def _manifest_entry(job_file, status, seq):
+    stat = job_file.stat()
+    return {"status": status, "mtime": stat.st_mtime, "size": stat.st_size, "seq": seq}
+
+def read_manifest(user_hash):
+    with _locked_manifest(user_hash) as manifest:
+        return manifest
+
+def write_job_state(user_hash, lesson_id, data):
+    job_file = JOBS_DIR / user_hash / f"{lesson_id}.json"
+    with _locked_manifest(user_hash) as manifest:
+        write_json_atomic(job_file, data)
+        manifest["seq"] += 1
+        manifest["jobs"][lesson_id] = _manifest_entry(job_file, data.get("status"), manifest["seq"])
+        write_json_atomic(MANIFESTS_DIR / f"{user_hash}.json", manifest)
+    notify_job_event()
+
+def report_progress(user_hash, lesson_id, stage, **details):
+    # Stati di avanzamento: queued, preparing_audio, transcribing (con chunks_done/chunks_total), summarizing.
+    write_job_state(user_hash, lesson_id, {"status": "processing", "progress": {"stage": stage, **details, "updated_at": time.time()}})
+
+def notify_job_event():
+    # Sveglia gli stream /events di questo processo; quelli di altri processi se ne accorgono al controllo periodico.
+    with _job_events:
+        _job_events.notify_all()
+
+# --- CACHE INDIRIZZATA PER CONTENUTO ---
+# Ogni voce è un file JSON in CACHE_DIR il cui nome è l'hash di tutto ciò che determina il
+# risultato (audio, modello, prompt). La data di modifica viene aggiornata a ogni lettura,
+# così l'eliminazione per dimensione rimuove per prime le voci usate meno di recente.
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def text_sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def cache_key(**parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _cache_path(key):
+    return CACHE_DIR / key[:2] / f"{key}.json"
+
+def cache_get(key):
+    if not CACHE_ENABLED:
+        return None
+    cache_file = _cache_path(key)
+    try:
+        with open(cache_file, 'r') as f:
+            value = json.load(f)["value"]
+        os.utime(cache_file)
+    except (OSError, json.JSONDecodeError, KeyError):
+        METRICS.inc("cache_lookups_total", result="miss")
+        return None
+    METRICS.inc("cache_lookups_total", result="hit")
+    return value
+
+def cache_put(key, value):
+    if not CACHE_ENABLED:
+        return
+    cache_file = _cache_path(key)
+    # La cache è solo un'ottimizzazione: un errore di scrittura non deve far fallire il job.
+    try:
+        cache_file.parent.mkdir(exist_ok=True)
+        write_json_atomic(cache_file, {"value": value, "created_at": time.time()})
+    except OSError as e:
+        print(f"Attenzione: impossibile salvare la voce di cache {key[:12]}: {e}")
+
+def evict_cache():
+    cutoff = time.time() - CACHE_MAX_AGE_DAYS * 86400
+    # File temporanei di write_text_atomic rimasti da un crash prima di os.replace:
+    # una scrittura dura al massimo pochi secondi, oltre l'intervallo di pulizia sono orfani.
+    temp_cutoff = time.time() - PURGE_INTERVAL_SECONDS
+    for temp_file in CACHE_DIR.glob("*/.*.tmp"):
+        try:
+            if temp_file.stat().st_mtime < temp_cutoff:
+                temp_file.unlink(missing_ok=True)
+        except FileNotFoundError:
+            continue
+    entries = []
+    for cache_file in CACHE_DIR.glob("*/*.json"):
+        try:
+            stat = cache_file.stat()
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime < cutoff:
+            cache_file.unlink(missing_ok=True)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cache_file))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, cache_file in sorted(entries):
+        if total_bytes <= CACHE_MAX_BYTES:
+            break
+        cache_file.unlink(missing_ok=True)
+        total_bytes -= size
+        removed += 1
+    if removed:
+        print(f"Cache: eliminate {removed} voci meno recenti, dimensione attuale {total_bytes} byte.")
+
+# --- CHECKPOINT DEI PASSAGGI ---
+# Per ogni job la cartella `<lesson_id>.work` accanto al file JSON contiene l'audio sanitizzato,
+# la trascrizione di ogni blocco (`chunk_NNN.txt`), la trascrizione assemblata e `state.json`
+# con i parametri del job e la durata rilevata.
+def job_work_dir(user_hash, lesson_id):
+    return JOBS_DIR / user_hash / f"{lesson_id}.work"
+
+def load_checkpoint(work_dir):
+    try:
+        with open(work_dir / "state.json", 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_checkpoint(work_dir, checkpoint):
+    write_json_atomic(work_dir / "state.json", checkpoint)
+
+def load_chunk_transcript(work_dir, chunk_index):
+    chunk_transcript_file = work_dir / f"chunk_{chunk_index:03d}.txt"
+    if not chunk_transcript_file.exists():
+        return None
+    return chunk_transcript_file.read_text(encoding='utf-8')
+
+def save_chunk_transcript(work_dir, chunk_index, text):
+    write_text_atomic(work_dir / f"chunk_{chunk_index:03d}.txt", text)
+    notify_job_event()
+
+def get_key_semaphore(user_hash):
+    with _key_semaphores_lock:
+        if user_hash not in _key_semaphores:
+            if _shared_limits is not None:
+                _key_semaphores[user_hash] = _shared_limits.key_semaphore(user_hash)
+            else:
+                _key_semaphores[user_hash] = threading.BoundedSemaphore(MAX_PARALLEL_CHUNKS_PER_KEY)
+        return _key_semaphores[user_hash]
+
+# Con JOB_WORKER_MODE=process ogni job gira in un processo figlio: limitatori e semafori per
+# chiave vivono in un unico processo manager avviato dal worker, e i figli li usano tramite
+# proxy. Così i job di una stessa chiave condividono quota, backoff e tetto di concorrenza
+# anche tra processi diversi. Il manager è un processo a sé (e non un thread del worker)
+# perché le sue connessioni usano letture bloccanti che con gevent fermerebbero l'hub.
+class RateLimiterProxy(BaseProxy):
+    _exposed_ = ("acquire", "release", "on_success", "on_rate_limited")
+
+    @contextmanager
+    def slot(self):
+        generation = self._callmethod("acquire")
+        try:
+            yield generation
+        finally:
+            self._callmethod("release")
+
+    def on_success(self, generation):
+        return self._callmethod("on_success", (generation,))
+
+    def on_rate_limited(self, generation):
+        return self._callmethod("on_rate_limited", (generation,))
+
+class SharedLimitsManager(BaseManager):
+    pass
+
+SharedLimitsManager.register("rate_limiter", callable=get_rate_limiter, proxytype=RateLimiterProxy)
+SharedLimitsManager.register("key_semaphore", callable=get_key_semaphore, proxytype=AcquirerProxy)
+
+def start_shared_limits():
+    """Avvia il manager dei limiti condivisi e restituisce (indirizzo, authkey) per i processi figli."""
+    global _shared_limits_server
+    authkey = secrets.token_bytes(32)
+    # Il riferimento globale tiene in vita il manager: alla sua raccolta il processo verrebbe chiuso.
+    _shared_limits_server = SharedLimitsManager(authkey=authkey, ctx=multiprocessing.get_context("spawn"))
+    _shared_limits_server.start()
+    return _shared_limits_server.address, authkey
+
+def connect_shared_limits(address, authkey):
+    # Inizializzatore dei processi figli dei job.
+    global _shared_limits
+    _shared_limits = SharedLimitsManager(address=address, authkey=authkey)
+    _shared_limits.connect()
+
+def _normalize_word(word):
+    return re.sub(r'\W+', '', word.lower())
+
+def stitch_transcripts(transcripts):
+    """Unisce le trascrizioni di blocchi audio sovrapposti eliminando il testo ripetuto.
+
+    Per ogni coppia di blocchi cerca la sequenza di parole comune più lunga tra la coda
+    del testo già unito e l'inizio del blocco successivo: il primo viene troncato alla fine
+    della sequenza e il secondo riprende subito dopo. Se non c'è una corrispondenza di
+    almeno STITCH_MIN_MATCH_WORDS parole, i due testi vengono semplicemente concatenati.
+    Il risultato dipende solo dai testi in ingresso.
+    """
+    stitched = ""
+    for text in transcripts:
+        text = text.strip()
+        if not text:
+            continue
+        if not stitched:
+            stitched = text
+            continue
+
+        tail_words = list(re.finditer(r'\S+', stitched))[-STITCH_WINDOW_WORDS:]
+        head_words = list(re.finditer(r'\S+', text))[:STITCH_WINDOW_WORDS]
+        tail_keys = [_normalize_word(m.group()) for m in tail_words]
+        head_keys = [_normalize_word(m.group()) for m in head_words]
+
+        match = difflib.SequenceMatcher(None, tail_keys, head_keys, autojunk=False).find_longest_match(0, len(tail_keys), 0, len(head_keys))
+        if match.size >= STITCH_MIN_MATCH_WORDS:
+            cut_tail = tail_words[match.a + match.size - 1].end()
+            cut_head = head_words[match.b + match.size - 1].end()
+            stitched = stitched[:cut_tail] + text[cut_head:]
+        else:
+            stitched = f"{stitched} {text}"
+    return stitched.strip()
+
+def speech_encode_command(input_arg, sanitized_file):
+    # Unica codifica dell'intera pipeline: l'upload grezzo diventa direttamente audio
+    # vocale mono a bassa frequenza di campionamento, pronto per essere diviso senza ricodifica.
+    return [
+        'ffmpeg', '-y', '-analyzeduration', '20M', '-probesize', '20M',
+        '-i', input_arg,
+        '-vn', '-ac', '1', '-ar', SPEECH_SAMPLE_RATE,
+        '-acodec', 'libmp3lame', '-b:a', SPEECH_BITRATE, '-f', 'mp3',
+        str(sanitized_file)
+    ]
+
+def prepare_audio(lesson_id, raw_input_file, sanitized_file, timings=None):
+    """Passaggi 1 e 2: converte l'upload in audio vocale e ne verifica l'integrità. Restituisce la durata in secondi."""
+    # --- PASSAGGIO 1: RIPARAZIONE E STANDARDIZZAZIONE FILE-TO-FILE ---
+    print(f"[{lesson_id}] Avvio passaggio di riparazione da file a file...")
+    
+    repair_command = speech_encode_command(str(raw_input_file), sanitized_file)
+    
+    with timed_stage(timings, "ffmpeg_repair"):
+        result = subprocess.run(repair_command, capture_output=True, text=True, check=False)
+    
+    if result.returncode != 0:
+        print(f"ERRORE FFMPEG (Riparazione): {result.stderr}")
+        raise RuntimeError("Fase 1 fallita: impossibile riparare il file audio.")
+
+    print(f"[{lesson_id}] File audio intermedio salvato. Avvio controllo di integrità...")
+    return check_sanitized_audio(lesson_id, sanitized_file, timings)
+
+def check_sanitized_audio(lesson_id, sanitized_file, timings=None):
+    """Passaggio 2: controllo di integrità dell'audio sanitizzato. Restituisce la durata in secondi."""
+    # --- PASSAGGIO 2: CONTROLLO DI INTEGRITÀ ---
+    if not sanitized_file.exists() or sanitized_file.stat().st_size < 1024:
+        raise RuntimeError("Fase 2 fallita: il processo di riparazione ha generato un file vuoto o troppo piccolo.")
+
+    probe_command = [
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1', str(sanitized_file)
+    ]
+    
+    with timed_stage(timings, "ffprobe"):
+        result = subprocess.run(probe_command, capture_output=True, text=True, check=False)
+
+    if result.returncode != 0:
+        print(f"ERRORE FFPROBE (Verifica): {result.stderr}")
+        raise RuntimeError("Fase 2 fallita: il file audio riparato è ancora illeggibile.")
+    
+    try:
+        duration_s = float(result.stdout.strip())
+    except ValueError:
+        raise RuntimeError(f"Fase 2 fallita: durata non valida rilevata da ffprobe ({result.stdout.strip()!r}).")
+
+    print(f"[{lesson_id}] Controllo di integrità superato. Durata rilevata: {duration_s}s.")
+    return duration_s
+
+def audio_chunk_count(duration_s):
+    # La tolleranza evita un ultimo blocco di pochi millisecondi quando la durata è un multiplo quasi esatto.
+    return max(1, math.ceil(duration_s / (CHUNK_LENGTH_MS / 1000) - 0.001))
+
+def split_audio_file(lesson_id, source_path, duration_s, chunk_dir, overlap_ms=0):
+    """Divide il file audio in blocchi da CHUNK_LENGTH_MS usando ffmpeg con seek e copia dei frame.
+
+    Ogni blocco è scritto direttamente in `chunk_dir` senza ricodifica; a partire dal secondo,
+    l'inizio viene anticipato di `overlap_ms`. Restituisce i percorsi dei blocchi in ordine.
+    """
+    chunk_length_s = CHUNK_LENGTH_MS / 1000
+    overlap_s = overlap_ms / 1000
+    total_chunks = audio_chunk_count(duration_s)
+
+    chunk_paths = []
+    for i in range(total_chunks):
+        start_s = max(0.0, i * chunk_length_s - overlap_s)
+        end_s = (i + 1) * chunk_length_s
+        chunk_path = Path(chunk_dir) / f"chunk_{i:03d}.mp3"
+
+        split_command = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-ss', f"{start_s:.3f}", '-i', str(source_path), '-t', f"{end_s - start_s:.3f}",
+            '-vn', '-c:a', 'copy', '-f', 'mp3',
+            str(chunk_path)
+        ]
+        result = subprocess.run(split_command, capture_output=True, text=True, check=False)
+
+        if result.returncode != 0 or not chunk_path.exists() or chunk_path.stat().st_size == 0:
+            print(f"ERRORE FFMPEG (Divisione blocco {i + 1}): {result.stderr}")
+            raise RuntimeError(f"Fase 3 fallita: impossibile estrarre il blocco audio {i + 1}/{total_chunks}.")
+
+        chunk_paths.append(chunk_path)
+
+    print(f"[{lesson_id}] Creati {total_chunks} blocchi audio.")
+    return chunk_paths
+
+def wait_for_file_processing(client, audio_file_resource):
+    # Attesa adattiva: i blocchi brevi sono pronti in pochi secondi, quindi si parte da un
+    # intervallo breve e lo si raddoppia fino a FILE_POLL_MAX_SECONDS.
+    poll_interval = FILE_POLL_INITIAL_SECONDS
+    with client.timed("file_processing_wait"):
+        while audio_file_resource.state.name == "PROCESSING":
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, FILE_POLL_MAX_SECONDS)
+            audio_file_resource = client.get_file(audio_file_resource.name)
+
+    if audio_file_resource.state.name == "FAILED":
+        raise ValueError("Elaborazione blocco audio fallita su Gemini.")
+    return audio_file_resource
+
+def transcribe_chunk(lesson_id, client, transcription_model, chunk_path, prompt, chunk_index, total_chunks):
+    # I blocchi abbastanza piccoli viaggiano dentro la richiesta stessa: niente caricamento
+    # tramite File API, niente attesa dello stato PROCESSING e niente eliminazione finale.
+    inline_audio = None
+    if Path(chunk_path).stat().st_size <= INLINE_AUDIO_MAX_BYTES:
+        inline_audio = {"mime_type": "audio/mpeg", "data": Path(chunk_path).read_bytes()}
+
+    audio_file_resource = None
+    try:
+        response = None
+        max_retries = 10
         for attempt in range(max_retries):
             try:
-                print(f"[{lesson_id}] Generazione riassunto e argomento (Tentativo {attempt + 1})...")
-                unified_response = summary_model.generate_content(
-                    unified_prompt, 
-                    generation_config=generation_config,
-                    request_options={'timeout': 1800}
-                )
+                if inline_audio is not None:
+                    print(f"[{lesson_id}] Invio blocco {chunk_index}/{total_chunks} a Gemini come audio inline (Tentativo {attempt + 1})...")
+                    METRICS.inc("gemini_upload_bytes_total", len(inline_audio["data"]), method="inline")
+                # Se il blocco è già stato caricato, un nuovo tentativo ripete solo la generazione.
+                elif audio_file_resource is None:
+                    print(f"[{lesson_id}] Caricamento blocco {chunk_index}/{total_chunks} a Gemini (Tentativo {attempt + 1})...")
+                    audio_file_resource = client.upload_file(chunk_path, mime_type="audio/mpeg")
+                    audio_file_resource = wait_for_file_processing(client, audio_file_resource)
+
+                audio_part = inline_audio if inline_audio is not None else audio_file_resource
+                response = client.generate_content(transcription_model, [prompt, audio_part], request_options={'timeout': 1800})
                 break
             except exceptions.ResourceExhausted as e:
-                wait_time = (2 ** attempt) * 5 + random.uniform(0, 1)
-                print(f"[{lesson_id}] Rate limit superato durante il riassunto/argomento. Dettagli API: {e}. Attendo {wait_time:.1f}s...")
-                time.sleep(wait_time)
+                # L'attesa è gestita dal limitatore condiviso della chiave: il prossimo tentativo parte quando riapre.
+                print(f"[{lesson_id}] Rate limit superato per trascrizione del blocco {chunk_index} (tentativo {attempt + 1}/{max_retries}). Dettagli API: {e}.")
+                METRICS.inc("gemini_retries_total", stage="transcription")
+            except Exception as e:
+                print(f"[{lesson_id}] Errore API imprevisto durante la trascrizione del blocco {chunk_index}: {e}")
+                raise
+
+        if response is None:
+            raise RuntimeError(f"Impossibile ottenere la trascrizione del blocco {chunk_index} dopo {max_retries} tentativi.")
+
+        print(f"[{lesson_id}] Trascrizione blocco {chunk_index}/{total_chunks} completata.")
+        return response.text
+    finally:
+        if audio_file_resource:
+            try:
+                client.delete_file(audio_file_resource.name)
+            except Exception as delete_error:
+                print(f"[{lesson_id}] Attenzione: impossibile eliminare file del blocco da Gemini. Errore: {delete_error}")
+
+def transcribe_chunk_cached(lesson_id, client, transcription_model, chunk_path, prompt, chunk_index, total_chunks, semaphore=None):
+    # Un blocco identico, con lo stesso modello e lo stesso prompt, riusa la trascrizione già ottenuta.
+    chunk_cache_key = cache_key(kind="chunk", audio=file_sha256(chunk_path), model=transcription_model.model_name, prompt=text_sha256(prompt))
+    text = cache_get(chunk_cache_key)
+    if text is not None:
+        print(f"[{lesson_id}] Blocco {chunk_index}/{total_chunks} trovato nella cache.")
+        return text
+    with semaphore or nullcontext():
+        text = transcribe_chunk(lesson_id, client, transcription_model, chunk_path, prompt, chunk_index, total_chunks)
+    cache_put(chunk_cache_key, text)
+    return text
+
+def transcribe_chunks_serial(lesson_id, client, transcription_model, chunk_paths, work_dir, on_chunk_transcribed=None):
+    # Modalità originale: ogni blocco riceve la coda della trascrizione precedente come contesto.
+    transcripts = []
+    for i, chunk_path in enumerate(chunk_paths):
+        text = load_chunk_transcript(work_dir, i)
+        if text is not None:
+            print(f"[{lesson_id}] Blocco {i + 1}/{len(chunk_paths)} ripreso dal checkpoint.")
+        else:
+            if not transcripts:
+                prompt = TRANSCRIPTION_PROMPT
+            else:
+                prompt = CONTINUATION_PROMPT_TEMPLATE.format(previous_context=transcripts[-1][-250:])
+            text = transcribe_chunk_cached(lesson_id, client, transcription_model, chunk_path, prompt, i + 1, len(chunk_paths))
+            save_chunk_transcript(work_dir, i, text)
+        transcripts.append(text)
+        if on_chunk_transcribed:
+            on_chunk_transcribed(i, len(chunk_paths), text)
+    return transcripts
+
+def transcribe_chunks_parallel(lesson_id, user_hash, client, transcription_model, chunk_paths, work_dir, on_chunk_transcribed=None):
+    # I blocchi sono indipendenti: vengono inviati insieme, rispettando il limite per chiave API.
+    semaphore = get_key_semaphore(user_hash)
+    total_chunks = len(chunk_paths)
+
+    def worker(i):
+        text = load_chunk_transcript(work_dir, i)
+        if text is not None:
+            print(f"[{lesson_id}] Blocco {i + 1}/{total_chunks} ripreso dal checkpoint.")
+        else:
+            prompt = TRANSCRIPTION_PROMPT if i == 0 else PARALLEL_SEGMENT_PROMPT
+            text = transcribe_chunk_cached(lesson_id, client, transcription_model, chunk_paths[i], prompt, i + 1, total_chunks, semaphore)
+            save_chunk_transcript(work_dir, i, text)
+        if on_chunk_transcribed:
+            on_chunk_transcribed(i, total_chunks, text)
+        return text
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(total_chunks, MAX_PARALLEL_CHUNKS_PER_KEY)))
+    try:
+        futures = [executor.submit(worker, i) for i in range(total_chunks)]
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def chunking_params(transcription_mode):
+    overlap_ms = CHUNK_OVERLAP_MS if transcription_mode == "parallel" else 0
+    return {"mode": transcription_mode, "chunk_length_ms": CHUNK_LENGTH_MS, "overlap_ms": overlap_ms}
+
+def transcribe_audio(lesson_id, user_hash, client, transcription_model, sanitized_file, duration_s, transcription_mode, work_dir, checkpoint, on_chunk_transcribed=None, timings=None):
+    """Passaggio 3: divide l'audio sanitizzato in blocchi, li trascrive e restituisce la trascrizione assemblata.
+
+    `on_chunk_transcribed(indice, totale, testo)` viene chiamata appena ogni blocco è disponibile.
+    """
+    # I blocchi vengono estratti direttamente da ffmpeg su disco: l'audio non viene mai
+    # decodificato interamente in memoria, qualunque sia la durata della lezione.
+    print(f"[{lesson_id}] Divisione del file audio MP3 in blocchi (modalità: {transcription_mode})...")
+
+    parallel = transcription_mode == "parallel"
+    chunking = chunking_params(transcription_mode)
+
+    # Le trascrizioni dei blocchi salvate sono riutilizzabili solo se la divisione è la stessa.
+    if checkpoint.get("chunking") != chunking:
+        for stale_transcript in work_dir.glob("chunk_*.txt"):
+            stale_transcript.unlink()
+        checkpoint["chunking"] = chunking
+        save_checkpoint(work_dir, checkpoint)
+
+    chunk_dir = Path(tempfile.mkdtemp(prefix=f"{lesson_id}_chunks_"))
+    try:
+        with timed_stage(timings, "split"):
+            chunk_paths = split_audio_file(lesson_id, sanitized_file, duration_s, chunk_dir, chunking["overlap_ms"])
+
+        with timed_stage(timings, "transcription"):
+            if parallel:
+                transcripts = transcribe_chunks_parallel(lesson_id, user_hash, client, transcription_model, chunk_paths, work_dir, on_chunk_transcribed)
+            else:
+                transcripts = transcribe_chunks_serial(lesson_id, client, transcription_model, chunk_paths, work_dir, on_chunk_transcribed)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    if parallel:
+        return stitch_transcripts(transcripts)
+    return " ".join(transcripts).strip()
+
+def request_summary_json(lesson_id, client, summary_model, unified_prompt):
+    """Invia un prompt che chiede un JSON con `summary` e `suggestedTopic`. Restituisce (summary, suggested_topic)."""
+    unified_response = None
+    max_retries = 3
+    generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
+    for attempt in range(max_retries):
+        try:
+            print(f"[{lesson_id}] Generazione riassunto e argomento (Tentativo {attempt + 1})...")
+            unified_response = client.generate_content(
+                summary_model,
+                unified_prompt, 
+                generation_config=generation_config,
+                request_options={'timeout': 1800}
+            )
+            break
+        except exceptions.ResourceExhausted as e:
+            print(f"[{lesson_id}] Rate limit superato durante il riassunto/argomento. Dettagli API: {e}.")
+            METRICS.inc("gemini_retries_total", stage="summary")
+    
+    if unified_response is None:
+        raise RuntimeError("Impossibile generare riassunto e argomento.")
+
+    try:
+        cleaned_text = unified_response.text.strip()
+        if cleaned_text.startswith("```json"):
+            cleaned_text = cleaned_text[7:]
+        if cleaned_text.endswith("```"):
+            cleaned_text = cleaned_text[:-3]
         
-        if unified_response is None:
-            raise RuntimeError("Impossibile generare riassunto e argomento.")
+        result_json = json.loads(cleaned_text)
+        summary = result_json['summary']
+        suggested_topic = result_json['suggestedTopic'].strip().replace('"', '')
+    except (json.JSONDecodeError, KeyError) as e:
+        print(f"[{lesson_id}] ERRORE: impossibile decodificare il JSON per riassunto/argomento. Risposta ricevuta: {unified_response.text}")
+        raise RuntimeError(f"Decodifica JSON fallita: {e}")
+
+    return summary, suggested_topic
 
+def generate_summary(lesson_id, client, summary_model, subject, transcript):
+    """Passaggi 4 e 5: genera riassunto e argomento con un'unica chiamata. Restituisce (summary, suggested_topic)."""
+    unified_prompt = UNIFIED_SUMMARY_PROMPT_TEMPLATE.format(subject=subject, transcript=transcript)
+    return request_summary_json(lesson_id, client, summary_model, unified_prompt)
+
+def split_transcript_sections(transcript):
+    # Usata quando la trascrizione arriva da checkpoint o cache e le trascrizioni dei blocchi non sono disponibili.
+    sections, current, size = [], [], 0
+    for word in transcript.split():
+        current.append(word)
+        size += len(word) + 1
+        if size >= SECTION_TARGET_CHARS:
+            sections.append(" ".join(current))
+            current, size = [], 0
+    if current:
+        sections.append(" ".join(current))
+    return sections
+
+def summarize_section(lesson_id, client, summary_model, subject, index, total, text):
+    section_prompt = SECTION_SUMMARY_PROMPT_TEMPLATE.format(subject=subject, index=index + 1, total=total, transcript=text)
+    section_cache_key = cache_key(kind="section", prompt=text_sha256(section_prompt), model=summary_model.model_name)
+    cached_section = cache_get(section_cache_key)
+    if cached_section is not None:
+        print(f"[{lesson_id}] Sintesi della sezione {index + 1}/{total} trovata nella cache.")
+        return cached_section
+
+    response = None
+    max_retries = 3
+    for attempt in range(max_retries):
         try:
-            cleaned_text = unified_response.text.strip()
-            if cleaned_text.startswith("```json"):
-                cleaned_text = cleaned_text[7:]
-            if cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[:-3]
-            
-            result_json = json.loads(cleaned_text)
-            summary = result_json['summary']
-            suggested_topic = result_json['suggestedTopic'].strip().replace('"', '')
-        except (json.JSONDecodeError, KeyError) as e:
-            print(f"[{lesson_id}] ERRORE: impossibile decodificare il JSON per riassunto/argomento. Risposta ricevuta: {unified_response.text}")
-            raise RuntimeError(f"Decodifica JSON fallita: {e}")
-
-        job_data = { "status": "completed", "result": { "transcript": transcript, "summary": summary, "suggestedTopic": suggested_topic } }
-        with open(job_file, 'w') as f:
-            json.dump(job_data, f)
+            print(f"[{lesson_id}] Sintesi della sezione {index + 1}/{total} (Tentativo {attempt + 1})...")
+            response = client.generate_content(summary_model, section_prompt, request_options={'timeout': 1800})
+            break
+        except exceptions.ResourceExhausted as e:
+            print(f"[{lesson_id}] Rate limit superato durante la sintesi della sezione {index + 1}. Dettagli API: {e}.")
+            METRICS.inc("gemini_retries_total", stage="section_summary")
+
+    if response is None:
+        raise RuntimeError(f"Impossibile generare la sintesi della sezione {index + 1}.")
+
+    cache_put(section_cache_key, response.text)
+    return response.text
+
+class SectionSummarizer:
+    """Fase "map" del riassunto gerarchico: ogni sezione viene riassunta in background
+    appena la sua trascrizione è pronta, mentre gli altri blocchi sono ancora in trascrizione."""
+
+    def __init__(self, lesson_id, client, summary_model, subject):
+        self.lesson_id = lesson_id
+        self.client = client
+        self.summary_model = summary_model
+        self.subject = subject
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_SECTION_SUMMARIES)
+
+    def submit(self, index, total, text):
+        # Con una sola sezione il riassunto in un'unica chiamata è più economico.
+        if total <= 1:
+            return
+        self._futures[index] = self._executor.submit(summarize_section, self.lesson_id, self.client, self.summary_model, self.subject, index, total, text)
+
+    @property
+    def submitted(self):
+        return len(self._futures)
+
+    def results(self):
+        return [self._futures[index].result() for index in sorted(self._futures)]
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def generate_merged_summary(lesson_id, client, summary_model, subject, section_summaries):
+    """Fase "reduce": unisce le sintesi delle sezioni in riassunto e argomento finali."""
+    sections = "\n\n".join(f"### Parte {i + 1}\n{section}" for i, section in enumerate(section_summaries))
+    merge_prompt = MERGE_SUMMARY_PROMPT_TEMPLATE.format(subject=subject, total=len(section_summaries), sections=sections)
+    print(f"[{lesson_id}] Unione di {len(section_summaries)} sintesi di sezione.")
+    return request_summary_json(lesson_id, client, summary_model, merge_prompt)
+
+# --- FUNZIONE DI ELABORAZIONE GEMINI ---
+# La trascrizione dei blocchi può avvenire in parallelo (blocchi sovrapposti e ricuciti)
+# oppure in serie, passando a ogni blocco il contesto del precedente.
+# La chiave API di Gemini (`api_key`) viene ancora passata per ogni singolo job,
+# preservando il modello "bring your own key" originale, ed è usata da un client dedicato.
+def transcribe_and_summarize_task(lesson_id, user_hash, api_key, raw_input_path_str, subject, transcription_model_name, summary_model_name, transcription_mode=DEFAULT_TRANSCRIPTION_MODE, summary_mode=DEFAULT_SUMMARY_MODE, enqueued_at=None, stream_dir=None):
+    print(f"[{lesson_id}] Inizio elaborazione per utente {user_hash[:8]}... (Trascrizione: {transcription_model_name}, Riassunto: {summary_model_name})")
+    # Tempi di ogni passaggio di questo tentativo, in secondi, salvati nel file del job.
+    started_at = time.monotonic()
+    timings = {}
+    if enqueued_at is not None:
+        timings["queue_wait"] = round(max(0.0, time.time() - enqueued_at), 3)
+        METRICS.observe("lecture_stage_seconds", timings["queue_wait"], stage="queue_wait")
+    
+    raw_input_file = Path(raw_input_path_str)
+    # Gli artefatti di ogni passaggio restano accanto al file del job finché il job non
+    # è completato, così un nuovo tentativo riparte dall'ultimo passaggio concluso.
+    work_dir = job_work_dir(user_hash, lesson_id)
+    work_dir.mkdir(exist_ok=True)
+    sanitized_file = work_dir / "sanitized.mp3"
+    transcript_file = work_dir / "transcript.txt"
+
+    checkpoint = load_checkpoint(work_dir)
+    checkpoint["params"] = {
+        "raw_input_path": raw_input_path_str, "subject": subject,
+        "transcription_model": transcription_model_name, "summary_model": summary_model_name,
+        "transcription_mode": transcription_mode, "summary_mode": summary_mode,
+    }
+    save_checkpoint(work_dir, checkpoint)
+    sanitized_ready = "duration_s" in checkpoint and sanitized_file.exists()
+    completed = False
+    summarizer = None
+    client = None
+
+    def job_timings():
+        timings["total"] = round(time.monotonic() - started_at, 3)
+        METRICS.observe("lecture_stage_seconds", timings["total"], stage="total")
+        return {**timings, "gemini": client.stats() if client is not None else {}}
+
+    try:
+        if sanitized_ready:
+            duration_s = checkpoint["duration_s"]
+            timings.update(checkpoint.get("audio_timings", {}))
+            print(f"[{lesson_id}] Audio sanitizzato ripreso dal checkpoint ({duration_s}s): passaggi 1 e 2 saltati.")
+        else:
+            report_progress(user_hash, lesson_id, "preparing_audio")
+            duration_s = None
+            if stream_dir is not None:
+                duration_s = await_stream_transcode(lesson_id, Path(stream_dir), sanitized_file, timings)
+            if duration_s is None:
+                duration_s = prepare_audio(lesson_id, raw_input_file, sanitized_file, timings)
+            checkpoint["duration_s"] = duration_s
+            # I tempi di preparazione dell'audio restano nel job anche nei tentativi che la saltano.
+            checkpoint["audio_timings"] = {stage: timings[stage] for stage in AUDIO_STAGES if stage in timings}
+            save_checkpoint(work_dir, checkpoint)
+            sanitized_ready = True
+        
+        # Client Gemini dedicato a questo job e legato alla chiave dell'utente: nessuna
+        # configurazione globale, quindi job concorrenti di utenti diversi non si scambiano la chiave.
+        client = GeminiClient(api_key, get_rate_limiter(user_hash))
+        transcription_model = client.model(transcription_model_name)
+        summary_model = client.model(summary_model_name)
+        if summary_mode == "map_reduce":
+            summarizer = SectionSummarizer(lesson_id, client, summary_model, subject)
+
+        chunks_done = set()
+        progress_lock = threading.Lock()
+
+        def on_chunk_transcribed(index, total, text):
+            with progress_lock:
+                chunks_done.add(index)
+                report_progress(user_hash, lesson_id, "transcribing", chunks_done=len(chunks_done), chunks_total=total, partial_transcript_available=True)
+            if summarizer is not None:
+                summarizer.submit(index, total, text)
+
+        if transcript_file.exists():
+            transcript = transcript_file.read_text(encoding='utf-8')
+            print(f"[{lesson_id}] Trascrizione completa ripresa dal checkpoint: passaggio 3 saltato.")
+        else:
+            if "audio_sha256" not in checkpoint:
+                checkpoint["audio_sha256"] = file_sha256(sanitized_file)
+                save_checkpoint(work_dir, checkpoint)
+            transcript_cache_key = cache_key(
+                kind="transcript", audio=checkpoint["audio_sha256"], model=transcription_model_name,
+                chunking=chunking_params(transcription_mode), prompt=TRANSCRIPTION_PROMPTS_SHA256,
+            )
+            transcript = cache_get(transcript_cache_key)
+            if transcript is not None:
+                print(f"[{lesson_id}] Trascrizione trovata nella cache per questo audio: passaggio 3 saltato.")
+            else:
+                report_progress(user_hash, lesson_id, "transcribing")
+                transcript = transcribe_audio(lesson_id, user_hash, client, transcription_model, sanitized_file, duration_s, transcription_mode, work_dir, checkpoint,
+                                              on_chunk_transcribed=on_chunk_transcribed, timings=timings)
+                cache_put(transcript_cache_key, transcript)
+            write_text_atomic(transcript_file, transcript)
+
+        print(f"[{lesson_id}] Trascrizione completa assemblata.")
+        
+        # --- 4 & 5. RIASSUNTO E ARGOMENTO ---
+        if summarizer is None:
+            summary_cache_key = cache_key(kind="summary", transcript=text_sha256(transcript), model=summary_model_name, subject=subject, prompt=text_sha256(UNIFIED_SUMMARY_PROMPT_TEMPLATE))
+        else:
+            summary_cache_key = cache_key(kind="summary_map_reduce", transcript=text_sha256(transcript), model=summary_model_name, subject=subject,
+                                          prompt=text_sha256(SECTION_SUMMARY_PROMPT_TEMPLATE + MERGE_SUMMARY_PROMPT_TEMPLATE))
+        cached_summary = cache_get(summary_cache_key)
+        if cached_summary is not None:
+            summary, suggested_topic = cached_summary["summary"], cached_summary["suggestedTopic"]
+            print(f"[{lesson_id}] Riassunto e argomento trovati nella cache: nessuna chiamata a Gemini.")
+        else:
+            report_progress(user_hash, lesson_id, "summarizing", partial_transcript_available=True)
+            with timed_stage(timings, "summary"):
+                if summarizer is not None and summarizer.submitted == 0 and audio_chunk_count(duration_s) > 1:
+                    # Trascrizione ripresa da checkpoint o cache: le sezioni si ricavano dal testo assemblato.
+                    # Con un solo blocco audio resta un'unica chiamata, come per una trascrizione appena fatta.
+                    sections = split_transcript_sections(transcript)
+                    for i, section in enumerate(sections):
+                        summarizer.submit(i, len(sections), section)
+
+                if summarizer is not None and summarizer.submitted > 0:
+                    summary, suggested_topic = generate_merged_summary(lesson_id, client, summary_model, subject, summarizer.results())
+                else:
+                    summary, suggested_topic = generate_summary(lesson_id, client, summary_model, subject, transcript)
+            cache_put(summary_cache_key, {"summary": summary, "suggestedTopic": suggested_topic})
+
+        job_data = { "status": "completed", "result": { "transcript": transcript, "summary": summary, "suggestedTopic": suggested_topic }, "timings": job_timings() }
+        write_job_state(user_hash, lesson_id, job_data)
+        METRICS.inc("jobs_finished_total", status="completed")
+        completed = True
         print(f"[{lesson_id}] Elaborazione completata con successo.")
 
     except exceptions.ResourceExhausted as e:
         print(f"ERRORE GRAVE (QUOTA ESAURITA) durante l'elaborazione per [{lesson_id}]: {e}")
-        error_data = {"status": "error", "message": f"RATE_LIMIT_EXCEEDED::{e}"}
-        with open(job_file, 'w') as f:
-            json.dump(error_data, f)
+        error_data = {"status": "error", "message": f"RATE_LIMIT_EXCEEDED::{e}", "resumable": sanitized_ready or raw_input_file.exists(), "timings": job_timings()}
+        write_job_state(user_hash, lesson_id, error_data)
+        METRICS.inc("jobs_finished_total", status="rate_limited")
     except Exception as e:
         print(f"ERRORE GRAVE durante l'elaborazione per [{lesson_id}]: {e}")
-        error_data = {"status": "error", "message": str(e)}
-        with open(job_file, 'w') as f:
-            json.dump(error_data, f)
+        error_data = {"status": "error", "message": str(e), "resumable": sanitized_ready or raw_input_file.exists(), "timings": job_timings()}
+        write_job_state(user_hash, lesson_id, error_data)
+        METRICS.inc("jobs_finished_total", status="error")
     finally:
-        if sanitized_temp_file and sanitized_temp_file.exists():
-            sanitized_temp_file.unlink()
-            print(f"[{lesson_id}] File temporaneo sanitizzato {sanitized_temp_file} eliminato.")
-        if raw_input_file and raw_input_file.exists():
+        if summarizer is not None:
+            summarizer.close()
+        if stream_dir is not None:
+            shutil.rmtree(stream_dir, ignore_errors=True)
+        if completed:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            print(f"[{lesson_id}] Checkpoint {work_dir} eliminati.")
+        # L'input originale serve ancora solo se l'audio sanitizzato non è stato prodotto.
+        if (completed or sanitized_ready) and raw_input_file.exists():
             raw_input_file.unlink()
             print(f"[{lesson_id}] File temporaneo di input {raw_input_file} eliminato.")
 
 
+# --- CODA PERSISTENTE DEI JOB ---
+# Ogni job in attesa è un file JSON in PENDING_DIR. Un worker lo reclama spostandolo
+# atomicamente in RUNNING_DIR (os.rename riesce per un solo processo) e, finché il job è
+# in esecuzione, ne aggiorna periodicamente la data di modifica. Una voce in RUNNING_DIR
+# che non riceve più aggiornamenti appartiene a un processo terminato e torna in coda.
+# L'audio caricato resta in INCOMING_DIR, sul disco persistente, fino al termine del job.
+# Gli ID delle lezioni sono unici solo per utente: voci in coda e audio in arrivo usano
+# quindi la chiave `<user_hash>_<lesson_id>`. In RUNNING_DIR il nome porta anche un
+# identificativo del claim, così un worker elimina solo la voce che ha reclamato lui.
+def new_lesson_id():
+    return f"lesson_{int(time.time() * 1000)}_{secrets.token_hex(3)}"
+
+def job_queue_key(user_hash, lesson_id):
+    return f"{user_hash}_{lesson_id}"
+
+def _queue_key_of(entry_file):
+    # "<chiave>.json" in PENDING_DIR, "<chiave>.<claim>.json" in RUNNING_DIR.
+    return entry_file.stem.split(".", 1)[0]
+
+def _read_queue_files(directory):
+    entries = []
+    for entry_file in directory.glob("*.json"):
+        try:
+            with open(entry_file, 'r') as f:
+                entries.append((entry_file, json.load(f)))
+        except (OSError, json.JSONDecodeError):
+            # La voce può essere stata reclamata da un altro worker nel frattempo.
+            continue
+    return entries
+
+def _read_queue_entries(directory):
+    return [entry for _, entry in _read_queue_files(directory)]
+
+def active_queue_keys():
+    return {_queue_key_of(p) for p in PENDING_DIR.glob("*.json")} | {_queue_key_of(p) for p in RUNNING_DIR.glob("*.json")}
+
+def queue_length():
+    return sum(1 for _ in PENDING_DIR.glob("*.json"))
+
+def queue_position(user_hash, lesson_id):
+    pending = sorted(_read_queue_entries(PENDING_DIR), key=lambda entry: entry['enqueued_at'])
+    for position, entry in enumerate(pending, start=1):
+        if entry['user_hash'] == user_hash and entry['lesson_id'] == lesson_id:
+            return position
+    return None
+
+def enqueue_job(entry):
+    write_json_atomic(PENDING_DIR / f"{job_queue_key(entry['user_hash'], entry['lesson_id'])}.json", entry)
+    with _queue_condition:
+        _queue_condition.notify()
+
+def claim_next_job():
+    pending = _read_queue_files(PENDING_DIR)
+    if not pending:
+        return None
+
+    # Equità tra utenti: prima chi ha meno job in esecuzione, poi il job in attesa da più tempo.
+    running_per_user = Counter(entry['user_hash'] for entry in _read_queue_entries(RUNNING_DIR))
+    pending.sort(key=lambda item: (running_per_user[item[1]['user_hash']], item[1]['enqueued_at']))
+
+    for entry_file, entry in pending:
+        running_file = RUNNING_DIR / f"{_queue_key_of(entry_file)}.{secrets.token_hex(4)}.json"
+        try:
+            os.rename(entry_file, running_file)
+        except FileNotFoundError:
+            continue
+        with _owned_jobs_lock:
+            _owned_jobs.add(running_file)
+        return entry, running_file
+    return None
+
+def recover_stale_jobs():
+    now = time.time()
+    for entry_file in RUNNING_DIR.glob("*.json"):
+        try:
+            if now - entry_file.stat().st_mtime < STALE_JOB_SECONDS:
+                continue
+            os.rename(entry_file, PENDING_DIR / f"{_queue_key_of(entry_file)}.json")
+        except FileNotFoundError:
+            continue
+        print(f"[{_queue_key_of(entry_file)}] Job interrotto rilevato: rimesso in coda.")
+        with _queue_condition:
+            _queue_condition.notify()
+
+def fail_orphaned_jobs():
+    # Job rimasti in "processing" senza una voce in coda (es. creati prima della coda persistente):
+    # l'audio originale non è più disponibile, quindi vengono chiusi con un errore.
+    # Stato e data di ogni job vengono dai manifest, senza aprire i file dei job (e le trascrizioni).
+    queued_keys = active_queue_keys()
+    now = time.time()
+    for user_dir in JOBS_DIR.iterdir():
+        if user_dir.name.startswith("_") or not user_dir.is_dir():
+            continue
+        user_hash = user_dir.name
+        for lesson_id, job in read_manifest(user_hash)["jobs"].items():
+            if job["status"] != "processing" or now - job["mtime"] < STALE_JOB_SECONDS:
+                continue
+            if job_queue_key(user_hash, lesson_id) in queued_keys:
+                continue
+            print(f"[{lesson_id}] Job orfano senza file di input: segnato come errore.")
+            write_job_state(user_hash, lesson_id, {"status": "error", "message": "Elaborazione interrotta dal riavvio del server. Ricarica il file."})
+
+def purge_expired_checkpoints():
+    cutoff = time.time() - CHECKPOINT_RETENTION_HOURS * 3600
+    active_keys = active_queue_keys()
+    for work_dir in JOBS_DIR.glob("*/*.work"):
+        try:
+            if job_queue_key(work_dir.parent.name, work_dir.name[:-len(".work")]) in active_keys or work_dir.stat().st_mtime > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"Checkpoint scaduto eliminato: {work_dir}")
+    for raw_input in INCOMING_DIR.iterdir():
+        try:
+            if raw_input.stem in active_keys or raw_input.stat().st_mtime > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        raw_input.unlink(missing_ok=True)
+        print(f"Input scaduto eliminato: {raw_input}")
+    for upload_dir in UPLOADS_DIR.iterdir():
+        # Sessioni di upload mai finalizzate: conta l'ultimo byte ricevuto, non la creazione.
+        try:
+            last_activity = max(p.stat().st_mtime for p in [upload_dir, *upload_dir.iterdir()])
+        except OSError:
+            continue
+        if last_activity > cutoff:
+            continue
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        print(f"Sessione di upload scaduta eliminata: {upload_dir.name}")
+
+def _housekeeping_loop():
+    # All'avvio recupera i job interrotti e fa pulizia, fuori dalla richiesta che ha avviato
+    # i worker (spesso il controllo di salute /status). Poi, a ogni battito, aggiorna i job in
+    # esecuzione in questo processo e rimette in coda quelli abbandonati da processi terminati,
+    # anche se i worker sono sempre occupati; ogni ora elimina i checkpoint scaduti e le voci
+    # di cache in eccesso.
+    try:
+        fail_orphaned_jobs()
+        recover_stale_jobs()
+        purge_expired_checkpoints()
+        evict_cache()
+    except Exception as e:
+        print(f"ERRORE durante il recupero dei job all'avvio: {e}")
+    last_purge = time.time()
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        with _owned_jobs_lock:
+            owned = list(_owned_jobs)
+        for running_file in owned:
+            try:
+                os.utime(running_file)
+            except FileNotFoundError:
+                pass
+        recover_stale_jobs()
+        if time.time() - last_purge >= PURGE_INTERVAL_SECONDS:
+            last_purge = time.time()
+            purge_expired_checkpoints()
+            evict_cache()
+
+def run_task_collecting_metrics(*args):
+    # Eseguita nei processi figli: le metriche del job tornano al padre, che le espone su /metrics.
+    transcribe_and_summarize_task(*args)
+    return METRICS.drain()
+
+def run_queued_job(entry, running_file, executor=None):
+    lesson_id = entry['lesson_id']
+    args = (lesson_id, entry['user_hash'], entry['api_key'], entry['raw_input_path'], entry['subject'],
+            entry['transcription_model'], entry['summary_model'], entry['transcription_mode'],
+            entry.get('summary_mode', DEFAULT_SUMMARY_MODE), entry.get('enqueued_at'), entry.get('stream_dir'))
+    try:
+        if executor is not None:
+            METRICS.merge(executor.submit(run_task_collecting_metrics, *args).result())
+        else:
+            transcribe_and_summarize_task(*args)
+    except Exception as e:
+        print(f"ERRORE GRAVE nel worker per [{lesson_id}]: {e}")
+        write_job_state(entry['user_hash'], lesson_id, {"status": "error", "message": str(e)})
+        METRICS.inc("jobs_finished_total", status="error")
+    finally:
+        with _owned_jobs_lock:
+            _owned_jobs.discard(running_file)
+        running_file.unlink(missing_ok=True)
+
+def _job_worker_loop(executor):
+    while True:
+        claimed = claim_next_job()
+        if claimed is None:
+            recover_stale_jobs()
+            with _queue_condition:
+                _queue_condition.wait(timeout=QUEUE_POLL_SECONDS)
+            continue
+        entry, running_file = claimed
+        print(f"[{entry['lesson_id']}] Job prelevato dalla coda (utente {entry['user_hash'][:8]}).")
+        run_queued_job(entry, running_file, executor)
+
+def queue_full_response(user_hash):
+    pending_jobs = queue_length()
+    if pending_jobs < MAX_QUEUED_JOBS:
+        return None
+    print(f"Richiesta rifiutata per {user_hash[:8]}: coda piena ({pending_jobs} job in attesa).")
+    response = jsonify({"error": "Coda di elaborazione piena, riprova più tardi", "queue_length": pending_jobs})
+    response.headers['Retry-After'] = '60'
+    return response, 429
+
+def start_job_workers():
+    # Avvio pigro e una sola volta per processo: funziona anche se gunicorn
+    # importa l'app prima del fork dei worker.
+    global _workers_pid
+    if _workers_pid == os.getpid() or JOB_WORKERS <= 0:
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+
+        executor = None
+        if JOB_WORKER_MODE == "process":
+            executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                           initializer=connect_shared_limits, initargs=start_shared_limits())
+
+        threading.Thread(target=_housekeeping_loop, daemon=True).start()
+        for _ in range(JOB_WORKERS):
+            threading.Thread(target=_job_worker_loop, args=(executor,), daemon=True).start()
+        print(f"Avviati {JOB_WORKERS} worker ({JOB_WORKER_MODE}) per la coda dei job.")
+
+
+# --- UPLOAD A BLOCCHI RIPRENDIBILE ---
+# Protocollo: POST /upload/init apre una sessione, PUT /upload/<id> aggiunge byte con
+# Content-Range a partire dall'offset già ricevuto, GET /upload/<id> restituisce l'offset
+# da cui riprendere dopo una disconnessione e POST /upload/<id>/finalize mette il job in coda.
+# I byte sono copiati dallo stream della richiesta al disco a blocchi, senza tenerli in memoria.
+UPLOAD_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+def upload_session_dir(upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return None
+    return UPLOADS_DIR / upload_id
+
+def load_upload_session(user_hash, upload_id):
+    upload_dir = upload_session_dir(upload_id)
+    if upload_dir is None:
+        return None, None
+    try:
+        with open(upload_dir / "meta.json", 'r') as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None, None
+    # Una sessione è visibile solo alla chiave API che l'ha aperta, e solo finché non è finalizzata.
+    if meta.get("user_hash") != user_hash or (upload_dir / UPLOAD_FINALIZED).exists():
+        return None, None
+    return upload_dir, meta
+
+@contextmanager
+def locked_upload_session(upload_dir, blocking=True):
+    # Un solo append (o la finalizzazione) per sessione alla volta, anche tra processi diversi.
+    # Restituisce False se la sessione è occupata e `blocking` è disattivato.
+    with open(upload_dir / ".lock", 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def append_upload_bytes(data_file, stream, max_bytes):
+    """Copia al massimo `max_bytes` dallo stream in coda al file. Restituisce la nuova dimensione.
+
+    I byte arrivati prima di un'eventuale disconnessione restano sul disco: il client
+    riprende dall'offset restituito da GET /upload/<id>.
+    """
+    remaining = max_bytes
+    with open(data_file, 'ab') as f:
+        try:
+            while remaining > 0:
+                block = stream.read(min(UPLOAD_COPY_BUFFER_BYTES, remaining))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+        finally:
+            f.flush()
+            os.fsync(f.fileno())
+            notify_upload_event()
+    return data_file.stat().st_size
+
+def notify_upload_event():
+    with _upload_events:
+        _upload_events.notify_all()
+
+# File di stato nella cartella della sessione, condivisi tra i processi:
+# la conversione in streaming scrive STREAM_STARTED all'avvio e STREAM_RESULT alla fine,
+# la finalizzazione scrive UPLOAD_FINALIZED quando l'ultimo byte è arrivato.
+STREAM_STARTED = "stream.started"
+STREAM_RESULT = "stream_result.json"
+STREAM_OUTPUT = "sanitized.mp3"
+UPLOAD_FINALIZED = "finalized"
+
+def open_upload_sessions(user_hash=None):
+    count = 0
+    for upload_dir in UPLOADS_DIR.iterdir():
+        if (upload_dir / UPLOAD_FINALIZED).exists():
+            continue
+        if user_hash is not None:
+            try:
+                with open(upload_dir / "meta.json", 'r') as f:
+                    if json.load(f).get("user_hash") != user_hash:
+                        continue
+            except (OSError, json.JSONDecodeError):
+                continue
+        count += 1
+    return count
+
+class StreamingTranscoder:
+    """Converte l'audio con ffmpeg mentre l'upload è ancora in corso.
+
+    Un thread legge il file della sessione man mano che cresce e lo passa a ffmpeg tramite
+    pipe, finché la sessione non viene finalizzata; il risultato (durata o fallimento) finisce
+    in STREAM_RESULT, da cui il job lo prende in carico. Se ffmpeg non riesce a leggere il
+    formato da una pipe (es. MP4 con l'indice in fondo) il job converte il file da sé.
+    """
+
+    def __init__(self, lesson_id, upload_dir, data_file):
+        self.lesson_id = lesson_id
+        self.upload_dir = upload_dir
+        self.data_file = data_file
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @classmethod
+    def start_for(cls, meta, upload_dir, data_file):
+        """Avvia la conversione se c'è un posto libero in questo processo. Restituisce True se avviata."""
+        global _active_stream_transcodes
+        with _stream_transcodes_lock:
+            if _active_stream_transcodes >= MAX_STREAM_TRANSCODES:
+                return False
+            _active_stream_transcodes += 1
+        try:
+            (upload_dir / STREAM_STARTED).touch()
+            cls(meta["lesson_id"], upload_dir, data_file)._thread.start()
+        except BaseException:
+            with _stream_transcodes_lock:
+                _active_stream_transcodes -= 1
+            raise
+        return True
+
+    def _run(self):
+        global _active_stream_transcodes
+        try:
+            self._transcode()
+        except OSError as e:
+            # Tipicamente la sessione è stata annullata o presa in carico e rimossa nel frattempo;
+            # altrimenti (ffmpeg non avviabile, errore di scrittura) il job non deve restare in attesa.
+            print(f"[{self.lesson_id}] Conversione in streaming interrotta: {e}")
+            if self.upload_dir.exists():
+                try:
+                    write_json_atomic(self.upload_dir / STREAM_RESULT, {"ok": False, "reason": "error"})
+                except OSError:
+                    pass
+                notify_upload_event()
+        finally:
+            with _stream_transcodes_lock:
+                _active_stream_transcodes -= 1
+
+    def _transcode(self):
+        started_at = time.monotonic()
+        sanitized_file = self.upload_dir / STREAM_OUTPUT
+        finalized_marker = self.upload_dir / UPLOAD_FINALIZED
+        with open(self.upload_dir / "ffmpeg.log", 'wb') as log, open(self.data_file, 'rb') as source:
+            process = subprocess.Popen(speech_encode_command('pipe:0', sanitized_file),
+                                       stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log)
+            fed_bytes = 0
+            last_data_at = time.monotonic()
+            try:
+                while True:
+                    block = source.read(UPLOAD_COPY_BUFFER_BYTES)
+                    if block:
+                        process.stdin.write(block)
+                        fed_bytes += len(block)
+                        last_data_at = time.monotonic()
+                        continue
+                    if finalized_marker.exists():
+                        # Gli ultimi byte possono essere arrivati dopo la lettura vuota precedente.
+                        for block in iter(lambda: source.read(UPLOAD_COPY_BUFFER_BYTES), b""):
+                            process.stdin.write(block)
+                            fed_bytes += len(block)
+                        break
+                    if not self.upload_dir.exists() or time.monotonic() - last_data_at > UPLOAD_STREAM_IDLE_SECONDS:
+                        process.kill()
+                        process.wait()
+                        if self.upload_dir.exists():
+                            write_json_atomic(self.upload_dir / STREAM_RESULT, {"ok": False, "reason": "idle"})
+                        return
+                    with _upload_events:
+                        _upload_events.wait(timeout=EVENTS_POLL_SECONDS)
+                process.stdin.close()
+            except (BrokenPipeError, ValueError):
+                # ffmpeg è terminato prima della fine dei dati: il codice di uscita dirà se è un errore.
+                pass
+            returncode = process.wait()
+
+        result = {"ok": False}
+        if returncode != 0:
+            print(f"[{self.lesson_id}] Conversione in streaming fallita dopo {fed_bytes} byte: verrà ripetuta dal job.")
+        else:
+            try:
+                result.update(ok=True, duration_s=check_sanitized_audio(self.lesson_id, sanitized_file))
+            except RuntimeError as e:
+                print(f"[{self.lesson_id}] Audio convertito in streaming scartato: {e}")
+        result["seconds"] = round(time.monotonic() - started_at, 3)
+        METRICS.observe("lecture_stage_seconds", result["seconds"], stage="stream_transcode")
+        write_json_atomic(self.upload_dir / STREAM_RESULT, result)
+        notify_upload_event()
+
+def await_stream_transcode(lesson_id, stream_dir, sanitized_file, timings=None):
+    """Nel job: attende la conversione in streaming della sessione e ne sposta il risultato.
+
+    Restituisce la durata dell'audio sanitizzato, oppure None se la conversione è fallita o
+    non avanza da UPLOAD_STREAM_STALL_SECONDS: in quel caso il job converte il file da sé.
+    L'attesa finisce nei tempi del job come "finalize_wait", la conversione come "stream_transcode".
+    """
+    with timed_stage(timings, "finalize_wait"):
+        result = _wait_stream_result(lesson_id, stream_dir)
+    if result is None or not result.get("ok"):
+        return None
+    if timings is not None:
+        timings["stream_transcode"] = result["seconds"]
+    os.replace(stream_dir / STREAM_OUTPUT, sanitized_file)
+    print(f"[{lesson_id}] Audio convertito durante l'upload: passaggi 1 e 2 già completati.")
+    return result["duration_s"]
+
+def _wait_stream_result(lesson_id, stream_dir):
+    last_progress = None
+    while True:
+        try:
+            with open(stream_dir / STREAM_RESULT, 'r') as f:
+                result = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            result = None
+        if result is not None:
+            return result
+
+        # L'output di ffmpeg cresce finché la conversione avanza.
+        try:
+            progress = max(p.stat().st_mtime for p in (stream_dir / STREAM_STARTED, stream_dir / STREAM_OUTPUT) if p.exists())
+        except (OSError, ValueError):
+            return None
+        if progress != last_progress:
+            last_progress, last_progress_at = progress, time.monotonic()
+        elif time.monotonic() - last_progress_at > UPLOAD_STREAM_STALL_SECONDS:
+            print(f"[{lesson_id}] Conversione in streaming ferma da {UPLOAD_STREAM_STALL_SECONDS}s: il job converte il file da sé.")
+            return None
+        with _upload_events:
+            _upload_events.wait(timeout=EVENTS_POLL_SECONDS)
+
+def read_job_options(values):
+    """Legge e valida i parametri del job da un form o da un JSON. Restituisce (opzioni, risposta di errore)."""
+    options = {
+        "subject": values.get('subject', 'N/A'),
+        "transcription_model": values.get('transcription_model', 'gemini-1.5-flash'),
+        "summary_model": values.get('summary_model', 'gemini-1.5-pro'),
+        "transcription_mode": values.get('transcription_mode', DEFAULT_TRANSCRIPTION_MODE),
+        "summary_mode": values.get('summary_mode', DEFAULT_SUMMARY_MODE),
+    }
+    if options["transcription_mode"] not in TRANSCRIPTION_MODES:
+        return None, (jsonify({"error": f"Modalità di trascrizione non valida: {options['transcription_mode']}"}), 400)
+    if options["summary_mode"] not in SUMMARY_MODES:
+        return None, (jsonify({"error": f"Modalità di riassunto non valida: {options['summary_mode']}"}), 400)
+    return options, None
+
+def enqueue_uploaded_job(user_hash, api_key, lesson_id, raw_input_path, options, stream_dir=None):
+    """Registra il job come in coda e restituisce la sua posizione.
+
+    `stream_dir` è la sessione di upload la cui conversione in streaming il job deve prendere in carico.
+    """
+    (JOBS_DIR / user_hash).mkdir(exist_ok=True)
+    report_progress(user_hash, lesson_id, "queued")
+    entry = {
+        "lesson_id": lesson_id, "user_hash": user_hash, "api_key": api_key,
+        "raw_input_path": str(raw_input_path), **options, "enqueued_at": time.time(),
+    }
+    if stream_dir is not None:
+        entry["stream_dir"] = str(stream_dir)
+    enqueue_job(entry)
+    position = queue_position(user_hash, lesson_id)
+    print(f"Nuovo job in coda: utente={user_hash[:8]}, ID={lesson_id}, Trascrizione={options['transcription_model']}, Riassunto={options['summary_model']}, Modalità={options['transcription_mode']}/{options['summary_mode']}, Posizione={position}")
+    return position
+
 # --- ENDPOINT DELL'API ---
-# NESSUNA MODIFICA: Tutti gli endpoint e la loro logica sono invariati.
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.monotonic()
+
+@app.before_request
+def ensure_job_workers():
+    start_job_workers()
+
 @app.before_request
 def check_api_key():
     if request.method == 'OPTIONS': return
-    if request.endpoint not in ['status', 'run_app']:
+    if request.endpoint not in ['status', 'metrics', 'run_app']:
         if not request.headers.get('X-API-Key'):
             return jsonify({"error": "Header X-API-Key mancante"}), 401
 
+@app.after_request
+def record_request_metrics(response):
+    # Per gli stream SSE misura il tempo fino all'invio delle intestazioni, non la durata dello stream.
+    started_at = g.get('request_started_at')
+    if started_at is not None:
+        METRICS.observe("http_request_seconds", time.monotonic() - started_at,
+                        endpoint=request.endpoint or "unmatched", method=request.method, status=response.status_code)
+    return response
+
 @app.route('/status', methods=['GET'])
 def status(): 
     return jsonify({"status": "ok"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    gauges = [
+        ("job_queue_depth", {"state": "pending"}, queue_length()),
+        ("job_queue_depth", {"state": "running"}, sum(1 for _ in RUNNING_DIR.glob("*.json"))),
+        ("upload_sessions_open", {}, open_upload_sessions()),
+    ]
+    return Response(METRICS.render(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     api_key = request.headers.get('X-API-Key')
     user_hash = get_user_hash(api_key)
-    user_dir = JOBS_DIR / user_hash
-    user_dir.mkdir(exist_ok=True)
     if 'file' not in request.files: return jsonify({"error": "Nessun file fornito"}), 400
     
     file = request.files['file']
-    subject = request.form.get('subject', 'N/A')
-    transcription_model = request.form.get('transcription_model', 'gemini-1.5-flash')
-    summary_model = request.form.get('summary_model', 'gemini-1.5-pro')
+    options, error = read_job_options(request.form)
+    if error: return error
     
+    queue_full = queue_full_response(user_hash)
+    if queue_full: return queue_full
+
+    lesson_id = new_lesson_id()
     suffix = Path(file.filename).suffix if file.filename else '.tmp'
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_f:
-        raw_input_path = Path(temp_f.name)
-        file.save(raw_input_path)
+    raw_input_path = INCOMING_DIR / f"{job_queue_key(user_hash, lesson_id)}{suffix}"
+    file.save(raw_input_path)
+    METRICS.inc("upload_received_bytes_total", raw_input_path.stat().st_size, endpoint="upload")
 
-    lesson_id = f"lesson_{int(time.time() * 1000)}"
-    with open(user_dir / f"{lesson_id}.json", 'w') as f: json.dump({"status": "processing"}, f)
-    
-    thread = threading.Thread(target=transcribe_and_summarize_task, args=(lesson_id, user_hash, api_key, str(raw_input_path), subject, transcription_model, summary_model))
-    thread.start()
-    
-    print(f"Nuovo job creato: utente={user_hash[:8]}, ID={lesson_id}, Trascrizione={transcription_model}, Riassunto={summary_model}")
-    return jsonify({"lesson_id": lesson_id})
+    position = enqueue_uploaded_job(user_hash, api_key, lesson_id, raw_input_path, options)
+    return jsonify({"lesson_id": lesson_id, "queue_position": position})
+
+@app.route('/upload/init', methods=['POST'])
+def init_upload():
+    # Apre una sessione di upload riprendibile. Accetta gli stessi parametri di /upload
+    # (come form o JSON), più `filename`, `total_size` e `stream_transcode`.
+    api_key = request.headers.get('X-API-Key')
+    user_hash = get_user_hash(api_key)
+    values = request.get_json(silent=True) or request.form
+    options, error = read_job_options(values)
+    if error: return error
+
+    total_size = values.get('total_size')
+    if total_size is not None:
+        try:
+            total_size = int(total_size)
+        except (TypeError, ValueError):
+            return jsonify({"error": "total_size non valido"}), 400
+        if total_size <= 0: return jsonify({"error": "total_size non valido"}), 400
+        if total_size > UPLOAD_MAX_BYTES: return jsonify({"error": "File troppo grande", "max_bytes": UPLOAD_MAX_BYTES}), 413
+
+    queue_full = queue_full_response(user_hash)
+    if queue_full: return queue_full
+    if open_upload_sessions(user_hash) >= MAX_OPEN_UPLOADS_PER_USER:
+        response = jsonify({"error": "Troppe sessioni di upload aperte per questa chiave API: completane o annullane una",
+                            "max_open_uploads": MAX_OPEN_UPLOADS_PER_USER})
+        response.headers['Retry-After'] = str(UPLOAD_STREAM_IDLE_SECONDS)
+        return response, 429
+
+    stream_transcode = str(values.get('stream_transcode', '1' if UPLOAD_STREAM_TRANSCODE else '0')).lower() in ('1', 'true')
+    filename = values.get('filename')
+    upload_id = secrets.token_urlsafe(16)
+    upload_dir = UPLOADS_DIR / upload_id
+    upload_dir.mkdir(mode=0o700)
+    meta = {
+        "upload_id": upload_id, "user_hash": user_hash, "lesson_id": new_lesson_id(),
+        "suffix": Path(filename).suffix if filename else '.tmp', "total_size": total_size,
+        "options": options, "stream_transcode": stream_transcode, "created_at": time.time(),
+    }
+    data_file = upload_dir / f"data{meta['suffix']}"
+    data_file.touch()
+    write_json_atomic(upload_dir / "meta.json", meta)
+
+    print(f"Sessione di upload aperta: utente={user_hash[:8]}, ID={meta['lesson_id']}, dimensione={total_size}, conversione in streaming={stream_transcode}")
+    return jsonify({"upload_id": upload_id, "offset": 0, "total_size": total_size})
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    user_hash = get_user_hash(request.headers.get('X-API-Key'))
+    upload_dir, meta = load_upload_session(user_hash, upload_id)
+    if meta is None: return jsonify({"status": "not_found"}), 404
+    offset = (upload_dir / f"data{meta['suffix']}").stat().st_size
+    return jsonify({"upload_id": upload_id, "offset": offset, "total_size": meta["total_size"]})
+
+@app.route('/upload/<upload_id>', methods=['PUT'])
+def append_upload(upload_id):
+    # Corpo della richiesta: i byte grezzi dell'intervallo indicato da
+    # "Content-Range: bytes <inizio>-<fine>/<totale o *>". L'inizio deve coincidere con l'offset attuale.
+    user_hash = get_user_hash(request.headers.get('X-API-Key'))
+    upload_dir, meta = load_upload_session(user_hash, upload_id)
+    if meta is None: return jsonify({"status": "not_found"}), 404
+
+    match = CONTENT_RANGE_PATTERN.match(request.headers.get('Content-Range', ''))
+    if not match: return jsonify({"error": "Header Content-Range mancante o non valido"}), 400
+    start, end = int(match.group(1)), int(match.group(2))
+    if end < start: return jsonify({"error": "Intervallo Content-Range non valido"}), 400
+    if match.group(3) != '*' and meta["total_size"] is not None and int(match.group(3)) != meta["total_size"]:
+        return jsonify({"error": "Dimensione totale diversa da quella dichiarata", "total_size": meta["total_size"]}), 400
+    if meta["total_size"] is not None and end >= meta["total_size"]:
+        return jsonify({"error": "Intervallo oltre la dimensione dichiarata", "total_size": meta["total_size"]}), 400
+    if end >= UPLOAD_MAX_BYTES:
+        return jsonify({"error": "File troppo grande", "max_bytes": UPLOAD_MAX_BYTES}), 413
+
+    data_file = upload_dir / f"data{meta['suffix']}"
+    try:
+        with locked_upload_session(upload_dir, blocking=False) as acquired:
+            if not acquired:
+                return jsonify({"error": "Un altro blocco è in corso di caricamento per questa sessione", "offset": data_file.stat().st_size}), 409
+            offset = data_file.stat().st_size
+            if start != offset:
+                return jsonify({"error": "L'intervallo non riprende dall'offset attuale", "offset": offset}), 409
+            offset = append_upload_bytes(data_file, request.stream, end - start + 1)
+            # La conversione parte solo quando arrivano i primi byte, così le sessioni aperte
+            # e mai usate non occupano un processo ffmpeg.
+            if meta["stream_transcode"] and offset > 0 and not (upload_dir / STREAM_STARTED).exists():
+                if not StreamingTranscoder.start_for(meta, upload_dir, data_file):
+                    print(f"[{meta['lesson_id']}] Troppe conversioni in streaming attive: l'audio verrà convertito dal job.")
+                    (upload_dir / STREAM_STARTED).touch()
+                    write_json_atomic(upload_dir / STREAM_RESULT, {"ok": False, "reason": "busy"})
+    except FileNotFoundError:
+        # La sessione è stata annullata (DELETE) durante l'append.
+        return jsonify({"status": "not_found"}), 404
+    METRICS.inc("upload_received_bytes_total", offset - start, endpoint="append_upload")
+    return jsonify({"upload_id": upload_id, "offset": offset, "total_size": meta["total_size"]})
+
+@app.route('/upload/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    user_hash = get_user_hash(request.headers.get('X-API-Key'))
+    upload_dir, meta = load_upload_session(user_hash, upload_id)
+    if meta is None: return jsonify({"status": "not_found"}), 404
+    # L'eventuale conversione in streaming si ferma da sola quando la cartella scompare.
+    shutil.rmtree(upload_dir, ignore_errors=True)
+    return jsonify({"status": "aborted"})
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    api_key = request.headers.get('X-API-Key')
+    user_hash = get_user_hash(api_key)
+    upload_dir, meta = load_upload_session(user_hash, upload_id)
+    if meta is None: return jsonify({"status": "not_found"}), 404
+
+    queue_full = queue_full_response(user_hash)
+    if queue_full: return queue_full
+
+    lesson_id = meta["lesson_id"]
+    data_file = upload_dir / f"data{meta['suffix']}"
+    try:
+        # Mai un lock bloccante qui: un PUT lento tiene il lock per tutta la lettura del corpo e,
+        # con gevent, l'attesa fermerebbe l'intero processo, PUT compreso.
+        with locked_upload_session(upload_dir, blocking=False) as acquired:
+            if not data_file.exists(): return jsonify({"status": "not_found"}), 404
+            if not acquired:
+                return jsonify({"error": "Un blocco è ancora in corso di caricamento per questa sessione", "offset": data_file.stat().st_size}), 409
+            size = data_file.stat().st_size
+            if size == 0: return jsonify({"error": "Nessun byte ricevuto", "offset": 0}), 400
+            if meta["total_size"] is not None and size != meta["total_size"]:
+                return jsonify({"error": "Upload incompleto", "offset": size, "total_size": meta["total_size"]}), 409
+
+            raw_input_path = INCOMING_DIR / f"{job_queue_key(user_hash, lesson_id)}{meta['suffix']}"
+            os.replace(data_file, raw_input_path)
+
+            # Senza attendere la conversione in streaming: se è ancora in corso (o riuscita) la
+            # sessione passa al job, che ne prende il risultato; altrimenti il job converte il file da sé.
+            stream_dir = None
+            if (upload_dir / STREAM_STARTED).exists():
+                try:
+                    with open(upload_dir / STREAM_RESULT, 'r') as f:
+                        stream_ok = json.load(f).get("ok")
+                except (OSError, json.JSONDecodeError):
+                    stream_ok = True
+                if stream_ok:
+                    stream_dir = upload_dir
+            (upload_dir / UPLOAD_FINALIZED).touch()
+            notify_upload_event()
+    except FileNotFoundError:
+        # La sessione è stata annullata (DELETE) durante la finalizzazione.
+        return jsonify({"status": "not_found"}), 404
+    if stream_dir is None:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+    position = enqueue_uploaded_job(user_hash, api_key, lesson_id, raw_input_path, meta["options"], stream_dir)
+    return jsonify({"lesson_id": lesson_id, "queue_position": position})
 
 @app.route('/result/<lesson_id>', methods=['GET'])
 def get_result(lesson_id):
@@ -326,20 +2070,116 @@ def get_result(lesson_id):
     
     if not job_file.exists(): return jsonify({"status": "not_found"}), 404
     
-    with open(job_file, 'r') as f: return jsonify(json.load(f))
+    with open(job_file, 'r') as f: data = json.load(f)
+    if data.get("status") == "processing":
+        position = queue_position(user_hash, lesson_id)
+        if position is not None: data["queue_position"] = position
+    return jsonify(data)
+
+@app.route('/result/<lesson_id>/events', methods=['GET'])
+def job_events(lesson_id):
+    # Server-Sent Events: "state" a ogni cambio di stato del job, "chunk" per ogni blocco
+    # trascritto appena disponibile. Lo stream termina con lo stato finale (completed o error).
+    api_key = request.headers.get('X-API-Key')
+    user_hash = get_user_hash(api_key)
+    job_file = JOBS_DIR / user_hash / f"{lesson_id}.json"
+    work_dir = job_work_dir(user_hash, lesson_id)
+
+    if not job_file.exists(): return jsonify({"status": "not_found"}), 404
+
+    def sse_event(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def stream():
+        last_state = None
+        sent_chunks = set()
+        last_sent_at = time.monotonic()
+        while True:
+            try:
+                with open(job_file, 'r') as f:
+                    state = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                state = last_state
+
+            if state != last_state:
+                last_state = state
+                last_sent_at = time.monotonic()
+                yield sse_event("state", state)
+
+            chunks_total = (state or {}).get("progress", {}).get("chunks_total")
+            for chunk_file in sorted(work_dir.glob("chunk_*.txt")):
+                chunk_index = int(chunk_file.stem.split("_")[1])
+                if chunk_index in sent_chunks:
+                    continue
+                try:
+                    text = chunk_file.read_text(encoding='utf-8')
+                except OSError:
+                    continue
+                sent_chunks.add(chunk_index)
+                last_sent_at = time.monotonic()
+                yield sse_event("chunk", {"index": chunk_index, "total": chunks_total, "text": text})
+
+            if state and state.get("status") in ["completed", "error"]:
+                return
+            if time.monotonic() - last_sent_at >= EVENTS_KEEPALIVE_SECONDS:
+                last_sent_at = time.monotonic()
+                yield ": keep-alive\n\n"
+            with _job_events:
+                _job_events.wait(timeout=EVENTS_POLL_SECONDS)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/result/<lesson_id>/retry', methods=['POST'])
+def retry_job(lesson_id):
+    api_key = request.headers.get('X-API-Key')
+    user_hash = get_user_hash(api_key)
+    job_file = JOBS_DIR / user_hash / f"{lesson_id}.json"
+
+    if not job_file.exists(): return jsonify({"status": "not_found"}), 404
+
+    with open(job_file, 'r') as f: data = json.load(f)
+    if data.get("status") != "error":
+        return jsonify({"error": "Solo i job terminati con errore possono essere ripresi", "status": data.get("status")}), 409
+
+    work_dir = job_work_dir(user_hash, lesson_id)
+    checkpoint = load_checkpoint(work_dir)
+    params = checkpoint.get("params")
+    sanitized_ready = "duration_s" in checkpoint and (work_dir / "sanitized.mp3").exists()
+    if not params or not (sanitized_ready or Path(params['raw_input_path']).exists()):
+        return jsonify({"error": "Nessun dato salvato per riprendere questo job, ricarica il file"}), 409
+
+    queue_full = queue_full_response(user_hash)
+    if queue_full: return queue_full
+
+    report_progress(user_hash, lesson_id, "queued")
+    enqueue_job({"lesson_id": lesson_id, "user_hash": user_hash, "api_key": api_key, **params, "enqueued_at": time.time()})
+    position = queue_position(user_hash, lesson_id)
+
+    completed_chunks = len(list(work_dir.glob("chunk_*.txt")))
+    print(f"[{lesson_id}] Job rimesso in coda per un nuovo tentativo (audio pronto: {sanitized_ready}, blocchi già trascritti: {completed_chunks}).")
+    return jsonify({"lesson_id": lesson_id, "queue_position": position})
 
 @app.route('/sync', methods=['POST'])
 def sync_results():
     api_key = request.headers.get('X-API-Key')
     user_hash = get_user_hash(api_key)
     user_dir = JOBS_DIR / user_hash
+    body = request.get_json(silent=True) or {}
+
+    # Con `since` la risposta è incrementale; senza, il comportamento resta quello originale.
+    if 'since' in body or 'since' in request.args:
+        return sync_incremental(user_hash, body)
 
     if not user_dir.exists(): return jsonify([])
 
-    ids_to_check = request.json.get('known_ids', [])
+    ids_to_check = body.get('known_ids', [])
     completed_jobs = []
     
-    files_to_check = [user_dir / f"{lid}.json" for lid in ids_to_check] if ids_to_check else user_dir.glob("*.json")
+    if ids_to_check:
+        files_to_check = [user_dir / f"{lid}.json" for lid in ids_to_check]
+    else:
+        manifest = read_manifest(user_hash)
+        files_to_check = [user_dir / f"{lid}.json" for lid, entry in manifest["jobs"].items() if entry["status"] in ["completed", "error"]]
 
     for job_file in files_to_check:
         if not job_file.exists(): continue
@@ -356,7 +2196,48 @@ def sync_results():
         
     return jsonify(completed_jobs)
 
+def sync_incremental(user_hash, body):
+    # `since` è il cursore restituito dalla sincronizzazione precedente (0 per la prima).
+    # Con `metadata_only` vengono restituiti solo stato e dimensione; i contenuti si leggono da /result.
+    try:
+        since = int(body.get('since', request.args.get('since', 0)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Parametro 'since' non valido"}), 400
+    metadata_only = bool(body.get('metadata_only', request.args.get('metadata_only') == '1'))
+
+    manifest = read_manifest(user_hash)
+    full_resync = since > manifest["seq"]
+    if full_resync:
+        # Cursore più avanti del manifest (es. manifest ricostruito): si riparte da zero.
+        since = 0
+
+    etag = f'"{user_hash[:16]}-{since}-{manifest["seq"]}-{int(metadata_only)}"'
+    if request.headers.get('If-None-Match') == etag:
+        return '', 304
+
+    changed = sorted((entry["seq"], lesson_id, entry) for lesson_id, entry in manifest["jobs"].items() if entry["seq"] > since)
+    jobs = []
+    for _, lesson_id, entry in changed:
+        job = {"lesson_id": lesson_id, "status": entry["status"], "updated_at": entry["mtime"], "size": entry["size"]}
+        if not metadata_only and entry["status"] in ["completed", "error"]:
+            try:
+                with open(JOBS_DIR / user_hash / f"{lesson_id}.json", 'r') as f:
+                    job.update(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                print(f"Attenzione: file job corrotto durante sync: {lesson_id}")
+                continue
+        jobs.append(job)
+
+    if jobs:
+        print(f"Sincronizzazione incrementale per {user_hash[:8]}: {len(jobs)} job cambiati dal cursore {since}.")
+
+    response = jsonify({"cursor": manifest["seq"], "full_resync": full_resync, "jobs": jobs})
+    response.headers['ETag'] = etag
+    return response
+
 # --- BLOCCO DI AVVIO SERVER ---
 # <-- RIMOSSO: La funzione run_app() e il blocco if __name__ == '__main__' sono stati eliminati.
 # Un server di produzione come Gunicorn avvierà l'applicazione direttamente,
 # usando l'oggetto 'app' definito in questo file.
+# I worker della coda partono alla prima richiesta ricevuta da ciascun processo
+# (anche il controllo /status di Render), riprendendo i job rimasti in sospeso.
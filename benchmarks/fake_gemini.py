@@ -0,0 +1,157 @@
+"""Backend Gemini finto per i benchmark: nessuna chiamata di rete e nessuna quota consumata.
+
+Sostituisce i due client di servizio che `GeminiClient` crea per ogni job (File API e
+GenerativeService), così il resto del percorso resta quello reale: limitatore per chiave,
+metriche, audio inline o caricato, attesa dello stato PROCESSING, eliminazione dei file.
+
+Le risposte sono deterministiche: la "trascrizione" di un blocco dipende solo dai suoi byte
+e i 429 vengono iniettati con un generatore casuale inizializzato da un seme fisso.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions
+
+# Parole del testo sintetico: ~2,5 parole al secondo di parlato.
+WORDS = ("lezione", "teorema", "esempio", "quindi", "consideriamo", "funzione", "derivata",
+         "integrale", "vettore", "matrice", "ipotesi", "dimostrazione", "proprietà", "caso")
+WORDS_PER_SECOND = 2.5
+# Byte al secondo dell'audio vocale prodotto dall'app (MP3 mono a 32 kbit/s).
+AUDIO_BYTES_PER_SECOND = 32000 / 8
+
+
+@dataclass
+class FakeGeminiConfig:
+    upload_latency_s: float = 0.2        # per ogni caricamento con la File API
+    upload_latency_per_mb_s: float = 0.05
+    get_file_latency_s: float = 0.02
+    delete_latency_s: float = 0.02
+    processing_delay_s: float = 2.0      # tempo in stato PROCESSING dopo il caricamento
+    generate_latency_s: float = 1.0      # per ogni generate_content
+    generate_latency_per_mb_s: float = 0.2
+    rate_limit_probability: float = 0.0  # probabilità di un 429 per chiamata limitata
+    seed: int = 1234
+
+
+class FakeGeminiBackend:
+    """Stato condiviso dei client finti: file caricati, contatori e generatore dei 429."""
+
+    def __init__(self, config):
+        self.config = config
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._files = {}
+        self.calls = {"create_file": 0, "get_file": 0, "delete_file": 0, "generate_content": 0, "rate_limited": 0}
+        self.file_client = _FakeFileServiceClient(self)
+        self.generative_client = _FakeGenerativeServiceClient(self)
+
+    def install(self, app_module):
+        """Fa usare a ogni `GeminiClient` dell'app i client di questo backend."""
+        original_init = app_module.GeminiClient.__init__
+        backend = self
+
+        def __init__(client, api_key, limiter):
+            original_init(client, api_key, limiter)
+            client._file_client = backend.file_client
+            client._generative_client = backend.generative_client
+
+        app_module.GeminiClient.__init__ = __init__
+
+    def _count(self, call):
+        with self._lock:
+            self.calls[call] += 1
+
+    def _maybe_rate_limit(self):
+        with self._lock:
+            exhausted = self._random.random() < self.config.rate_limit_probability
+            if exhausted:
+                self.calls["rate_limited"] += 1
+        if exhausted:
+            raise exceptions.ResourceExhausted("Quota simulata esaurita (backend finto).")
+
+
+class _FakeFileServiceClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create_file(self, path, mime_type=None, name=None, display_name=None, resumable=True):
+        backend = self.backend
+        backend._count("create_file")
+        backend._maybe_rate_limit()
+        data = open(path, 'rb').read()
+        time.sleep(backend.config.upload_latency_s + backend.config.upload_latency_per_mb_s * len(data) / 1e6)
+        file_id = hashlib.sha256(data).hexdigest()[:16] + f"-{time.monotonic_ns()}"
+        with backend._lock:
+            backend._files[f"files/{file_id}"] = {"data": data, "ready_at": time.monotonic() + backend.config.processing_delay_s,
+                                                  "mime_type": mime_type or "audio/mpeg", "display_name": display_name or ""}
+        return self.get_file(name=f"files/{file_id}", count=False)
+
+    def get_file(self, name, count=True):
+        backend = self.backend
+        if count:
+            backend._count("get_file")
+            time.sleep(backend.config.get_file_latency_s)
+        with backend._lock:
+            stored = backend._files.get(name)
+        if stored is None:
+            raise exceptions.NotFound(f"File {name} inesistente.")
+        state = glm.File.State.ACTIVE if time.monotonic() >= stored["ready_at"] else glm.File.State.PROCESSING
+        return glm.File(name=name, display_name=stored["display_name"], mime_type=stored["mime_type"],
+                        size_bytes=len(stored["data"]), uri=f"https://fake.invalid/{name}", state=state)
+
+    def delete_file(self, request=None, name=None):
+        backend = self.backend
+        backend._count("delete_file")
+        time.sleep(backend.config.delete_latency_s)
+        with backend._lock:
+            backend._files.pop(request.name if request is not None else name, None)
+
+
+class _FakeGenerativeServiceClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generate_content(self, request, **request_options):
+        backend = self.backend
+        backend._count("generate_content")
+        backend._maybe_rate_limit()
+
+        audio = b""
+        prompt_chars = 0
+        for content in request.contents:
+            for part in content.parts:
+                if part.inline_data.data:
+                    audio += part.inline_data.data
+                elif part.file_data.file_uri:
+                    name = part.file_data.file_uri.split("fake.invalid/", 1)[-1]
+                    with backend._lock:
+                        stored = backend._files.get(name)
+                    if stored is None:
+                        raise exceptions.NotFound(f"File {name} inesistente.")
+                    audio += stored["data"]
+                else:
+                    prompt_chars += len(part.text)
+
+        payload_mb = (len(audio) + prompt_chars) / 1e6
+        time.sleep(backend.config.generate_latency_s + backend.config.generate_latency_per_mb_s * payload_mb)
+
+        if request.generation_config.response_mime_type == "application/json":
+            text = json.dumps({"summary": f"Riassunto sintetico di {prompt_chars} caratteri.", "suggestedTopic": "Argomento sintetico"})
+        else:
+            text = synthetic_transcript(audio)
+        return glm.GenerateContentResponse(candidates=[glm.Candidate(
+            content=glm.Content(parts=[glm.Part(text=text)], role="model"),
+            finish_reason=glm.Candidate.FinishReason.STOP,
+        )])
+
+
+def synthetic_transcript(audio):
+    """Testo deterministico lungo quanto il parlato contenuto nell'audio."""
+    word_count = max(1, int(len(audio) / AUDIO_BYTES_PER_SECOND * WORDS_PER_SECOND))
+    generator = random.Random(hashlib.sha256(audio).digest())
+    return " ".join(generator.choice(WORDS) for _ in range(word_count))
@@ -0,0 +1,396 @@
+"""Benchmark offline della pipeline completa, senza consumare quota Gemini.
+
+Genera (o riusa) lezioni sintetiche, avvia l'app Flask in questo processo con il backend
+Gemini finto di `fake_gemini.py` e la guida con più client concorrenti attraverso
+/upload (o l'upload a blocchi), /result e /sync, esattamente come farebbe il frontend.
+
+Alla fine riporta il tempo per passaggio (dai `timings` dei job), le chiamate a Gemini,
+la latenza degli endpoint, il picco di memoria (RSS) e i job all'ora, e salva tutto in JSON.
+Con --compare confronta il risultato con un'esecuzione precedente e termina con codice 1
+se un indicatore peggiora oltre la tolleranza.
+
+I semi fissi rendono identici audio, trascrizioni e sequenza dei 429 simulati; restano
+variabili solo i tempi reali di ffmpeg e l'ordine dei thread, quindi per confrontare due
+esecuzioni conviene usare la stessa macchina e gli stessi parametri.
+
+Uso:
+    python benchmarks/run_benchmark.py --jobs 8 --concurrency 4 --duration 1800 -o risultati.json
+    python benchmarks/run_benchmark.py --jobs 8 --concurrency 4 --duration 1800 --compare risultati.json
+
+Le variabili d'ambiente dell'app vengono impostate prima di importarla: i job usano una
+cartella temporanea (JOBS_DIR), i worker della coda sono thread (il backend finto non
+esiste nei processi figli) e la cache è disattivata, salvo --cache.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+sys.path.insert(0, str(BENCHMARKS_DIR))
+
+from fake_gemini import FakeGeminiBackend, FakeGeminiConfig  # noqa: E402
+from synthetic_lecture import FORMATS, cached_lecture  # noqa: E402
+
+# Indicatori confrontati con --compare: (percorso nel JSON, True se più alto è meglio).
+COMPARED_METRICS = [
+    (("jobs_per_hour",), True),
+    (("peak_rss_mb", "app_process"), False),
+    (("peak_rss_mb", "process_tree"), False),
+    (("job_latency_s", "p50"), False),
+    (("job_latency_s", "p95"), False),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline della pipeline di trascrizione e riassunto.")
+    load = parser.add_argument_group("carico")
+    load.add_argument("--jobs", type=int, default=8, help="lezioni da elaborare")
+    load.add_argument("--concurrency", type=int, default=4, help="client che caricano e interrogano in parallelo")
+    load.add_argument("--users", type=int, default=2, help="chiavi API distinte tra cui ripartire i job")
+    load.add_argument("--duration", type=float, default=1800, help="durata di ogni lezione in secondi")
+    load.add_argument("--format", choices=sorted(FORMATS), default="mp3")
+    load.add_argument("--upload-mode", choices=("multipart", "chunked"), default="multipart")
+    load.add_argument("--upload-chunk-mb", type=float, default=8, help="dimensione dei blocchi in modalità chunked")
+    load.add_argument("--poll-interval", type=float, default=2.0, help="secondi tra due GET /result")
+    load.add_argument("--sync-interval", type=float, default=10.0, help="secondi tra due POST /sync")
+    load.add_argument("--transcription-mode", default="parallel")
+    load.add_argument("--summary-mode", default="map_reduce")
+
+    app_config = parser.add_argument_group("configurazione dell'app")
+    app_config.add_argument("--job-workers", type=int, default=2)
+    app_config.add_argument("--rpm", type=float, default=600, help="GEMINI_REQUESTS_PER_MINUTE per chiave")
+    app_config.add_argument("--backoff", type=float, default=1.0, help="attesa base del limitatore dopo un 429")
+    app_config.add_argument("--inline-max-mb", type=float, default=None, help="INLINE_AUDIO_MAX_MB (0 = sempre File API)")
+    app_config.add_argument("--stream-transcode", choices=("0", "1"), default="1")
+    app_config.add_argument("--cache", action="store_true", help="lascia attiva la cache dei risultati")
+
+    fake = parser.add_argument_group("backend Gemini finto")
+    fake.add_argument("--upload-latency", type=float, default=0.2)
+    fake.add_argument("--processing-delay", type=float, default=2.0)
+    fake.add_argument("--generate-latency", type=float, default=1.0)
+    fake.add_argument("--generate-latency-per-mb", type=float, default=0.2)
+    fake.add_argument("--rate-limit-probability", type=float, default=0.05)
+    fake.add_argument("--seed", type=int, default=1234)
+
+    output = parser.add_argument_group("risultati")
+    output.add_argument("--label", default="", help="etichetta libera salvata nel risultato")
+    output.add_argument("-o", "--output", help="file JSON in cui salvare il risultato")
+    output.add_argument("--compare", help="risultato JSON di riferimento")
+    output.add_argument("--tolerance", type=float, default=0.10, help="peggioramento relativo ammesso con --compare")
+    output.add_argument("--lecture-cache", default=str(Path(tempfile.gettempdir()) / "lecture_benchmark_audio"))
+    output.add_argument("--keep-jobs-dir", action="store_true", help="non eliminare la cartella dei job alla fine")
+    output.add_argument("--app-log", default=os.devnull, help="file in cui scrivere i messaggi dell'app durante il carico")
+    return parser.parse_args()
+
+
+def load_app(jobs_dir, args):
+    os.environ.update({
+        "JOBS_DIR": str(jobs_dir),
+        "JOB_WORKERS": str(args.job_workers),
+        "JOB_WORKER_MODE": "thread",
+        "MAX_QUEUED_JOBS": str(args.jobs + 1),
+        "GEMINI_REQUESTS_PER_MINUTE": str(args.rpm),
+        "CACHE_ENABLED": "1" if args.cache else "0",
+        "UPLOAD_STREAM_TRANSCODE": args.stream_transcode,
+    })
+    if args.inline_max_mb is not None:
+        os.environ["INLINE_AUDIO_MAX_MB"] = str(args.inline_max_mb)
+    sys.path.insert(0, str(REPO_DIR))
+    import app as app_module
+    app_module.RATE_LIMIT_BASE_BACKOFF_SECONDS = args.backoff
+    return app_module
+
+
+class RssSampler:
+    """Campiona l'RSS di questo processo e dei suoi discendenti (ffmpeg compresi) da /proc."""
+
+    def __init__(self, interval_s=0.2):
+        self.interval_s = interval_s
+        self.peak_self_kb = 0
+        self.peak_tree_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _rss_kb(pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    @staticmethod
+    def _children(pid):
+        children = []
+        for task_dir in Path(f"/proc/{pid}/task").glob("*"):
+            try:
+                children += [int(child) for child in (task_dir / "children").read_text().split()]
+            except OSError:
+                continue
+        return children
+
+    def _sample(self):
+        own = self._rss_kb(os.getpid())
+        total, pending = own, self._children(os.getpid())
+        while pending:
+            pid = pending.pop()
+            total += self._rss_kb(pid)
+            pending += self._children(pid)
+        self.peak_self_kb = max(self.peak_self_kb, own)
+        self.peak_tree_kb = max(self.peak_tree_kb, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self._sample()
+
+    def start(self):
+        if Path("/proc/self/status").exists():
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        else:
+            # Senza /proc (es. macOS) resta solo il picco del processo; ru_maxrss è in KB su Linux, in byte su macOS.
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_self_kb = max_rss // 1024 if sys.platform == "darwin" else max_rss
+            self.peak_tree_kb = self.peak_self_kb
+
+
+class LatencyLog:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def timed_request(self, name, send):
+        started_at = time.monotonic()
+        response = send()
+        with self._lock:
+            self.samples.setdefault(f"{name} {response.status_code}", []).append(time.monotonic() - started_at)
+        return response
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {"count": len(values), "mean": round(sum(values) / len(values), 3), "p50": round(percentile(values, 0.5), 3),
+            "p95": round(percentile(values, 0.95), 3), "max": round(max(values), 3)}
+
+
+def job_options(args):
+    return {"subject": "Benchmark", "transcription_mode": args.transcription_mode, "summary_mode": args.summary_mode}
+
+
+def upload_multipart(client, headers, lecture_path, args, latencies):
+    with open(lecture_path, "rb") as audio:
+        return latencies.timed_request("POST /upload", lambda: client.post(
+            "/upload", headers=headers, content_type="multipart/form-data",
+            data={"file": (audio, lecture_path.name), **job_options(args)},
+        ))
+
+
+def upload_chunked(client, headers, lecture_path, args, latencies):
+    total_size = lecture_path.stat().st_size
+    response = latencies.timed_request("POST /upload/init", lambda: client.post(
+        "/upload/init", headers=headers,
+        json={"filename": lecture_path.name, "total_size": total_size, **job_options(args)},
+    ))
+    if response.status_code != 200:
+        return response
+    upload_id = response.get_json()["upload_id"]
+    block_size = int(args.upload_chunk_mb * 1024 * 1024)
+    with open(lecture_path, "rb") as audio:
+        offset = 0
+        while offset < total_size:
+            block = audio.read(block_size)
+            content_range = f"bytes {offset}-{offset + len(block) - 1}/{total_size}"
+            response = latencies.timed_request("PUT /upload/<id>", lambda: client.put(
+                f"/upload/{upload_id}", headers={**headers, "Content-Range": content_range}, data=block,
+            ))
+            if response.status_code != 200:
+                return response
+            offset = response.get_json()["offset"]
+            audio.seek(offset)
+    return latencies.timed_request("POST /upload/<id>/finalize", lambda: client.post(f"/upload/{upload_id}/finalize", headers=headers))
+
+
+def run_client_job(app_module, index, lecture_path, args, latencies):
+    """Un client: carica una lezione e la segue fino al risultato, sincronizzando come il frontend."""
+    client = app_module.app.test_client()
+    headers = {"X-API-Key": f"benchmark-user-{index % args.users}"}
+    upload = upload_chunked if args.upload_mode == "chunked" else upload_multipart
+
+    submitted_at = time.monotonic()
+    while True:
+        response = upload(client, headers, lecture_path, args, latencies)
+        if response.status_code != 429:
+            break
+        time.sleep(min(float(response.headers.get("Retry-After", "5")), 5))
+    if response.status_code != 200:
+        return {"index": index, "status": f"upload_failed_{response.status_code}", "submitted_at": submitted_at, "finished_at": time.monotonic()}
+    lesson_id = response.get_json()["lesson_id"]
+
+    cursor, last_sync = 0, 0.0
+    while True:
+        time.sleep(args.poll_interval)
+        if time.monotonic() - last_sync >= args.sync_interval:
+            last_sync = time.monotonic()
+            sync = latencies.timed_request("POST /sync", lambda: client.post("/sync", headers=headers, json={"since": cursor}))
+            if sync.status_code == 200:
+                cursor = sync.get_json()["cursor"]
+        result = latencies.timed_request("GET /result/<id>", lambda: client.get(f"/result/{lesson_id}", headers=headers))
+        data = result.get_json()
+        if data.get("status") != "processing":
+            return {"index": index, "lesson_id": lesson_id, "status": data.get("status"), "message": data.get("message"),
+                    "timings": data.get("timings", {}), "submitted_at": submitted_at, "finished_at": time.monotonic()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(args, jobs, latencies, sampler, backend, wall_s):
+    completed = [job for job in jobs if job["status"] == "completed"]
+    stage_values, gemini_totals = {}, {}
+    for job in completed:
+        for stage, value in job["timings"].items():
+            if stage == "gemini":
+                for operation, stats in value.items():
+                    totals = gemini_totals.setdefault(operation, {"count": 0, "seconds": 0.0})
+                    totals["count"] += stats["count"]
+                    totals["seconds"] = round(totals["seconds"] + stats["seconds"], 3)
+            else:
+                stage_values.setdefault(stage, []).append(value)
+    job_latencies = [job["finished_at"] - job["submitted_at"] for job in completed]
+    return {
+        "label": args.label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "label")},
+        "wall_s": round(wall_s, 3),
+        "jobs": {"submitted": len(jobs), "completed": len(completed),
+                 "failed": [{"index": job["index"], "status": job["status"], "message": job.get("message")} for job in jobs if job["status"] != "completed"]},
+        "jobs_per_hour": round(len(completed) / wall_s * 3600, 2) if wall_s > 0 else None,
+        "job_latency_s": summarize(job_latencies),
+        "peak_rss_mb": {"app_process": round(sampler.peak_self_kb / 1024, 1), "process_tree": round(sampler.peak_tree_kb / 1024, 1)},
+        "stages_s": {stage: summarize(values) for stage, values in sorted(stage_values.items())},
+        "gemini_calls": gemini_totals,
+        "fake_backend_calls": backend.calls,
+        "http_s": {endpoint: summarize(values) for endpoint, values in sorted(latencies.samples.items())},
+    }
+
+
+def print_report(report):
+    print(f"\n=== Benchmark {report['label'] or ''} (commit {report['git_commit']}) ===")
+    print(f"Job completati: {report['jobs']['completed']}/{report['jobs']['submitted']} in {report['wall_s']}s"
+          f" -> {report['jobs_per_hour']} job/ora")
+    print(f"Latenza per job (s): {report['job_latency_s']}")
+    print(f"Picco RSS (MB): processo {report['peak_rss_mb']['app_process']}, con i processi figli {report['peak_rss_mb']['process_tree']}")
+    print("\nPassaggio             media     p50     p95     max")
+    for stage, stats in report["stages_s"].items():
+        print(f"{stage:<18} {stats['mean']:>8} {stats['p50']:>7} {stats['p95']:>7} {stats['max']:>7}")
+    print("\nChiamate Gemini:", json.dumps(report["gemini_calls"]))
+    print("Backend finto:", json.dumps(report["fake_backend_calls"]))
+    print("\nEndpoint                             n     p50     p95")
+    for endpoint, stats in report["http_s"].items():
+        print(f"{endpoint:<32} {stats['count']:>5} {stats['p50']:>7} {stats['p95']:>7}")
+    for failure in report["jobs"]["failed"]:
+        print(f"Job {failure['index']} non completato: {failure['status']} {failure['message'] or ''}")
+
+
+def compare_reports(report, baseline, tolerance):
+    """Stampa le differenze rispetto al riferimento e restituisce il numero di regressioni."""
+    def lookup(data, path):
+        for key in path:
+            data = (data or {}).get(key)
+        return data
+
+    metrics = list(COMPARED_METRICS)
+    metrics += [(("stages_s", stage, "p50"), False) for stage in sorted(set(report["stages_s"]) & set(baseline.get("stages_s", {})))]
+    regressions = 0
+    print(f"\n=== Confronto con {baseline.get('label') or 'riferimento'} (commit {baseline.get('git_commit')}) ===")
+    for path, higher_is_better in metrics:
+        current, previous = lookup(report, path), lookup(baseline, path)
+        if not isinstance(current, (int, float)) or not isinstance(previous, (int, float)) or previous == 0:
+            continue
+        change = (current - previous) / previous
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        regressions += worse
+        print(f"{'.'.join(path):<28} {previous:>10} -> {current:>10} ({change:+.1%}){'  REGRESSIONE' if worse else ''}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        sys.exit("ffmpeg e ffprobe devono essere nel PATH.")
+
+    # Una lezione diversa per job (semi diversi), così né la cache né il backend vedono audio identici.
+    print(f"Preparazione di {args.jobs} lezioni sintetiche da {args.duration}s ({args.format})...")
+    lectures = [cached_lecture(args.lecture_cache, args.duration, args.format, seed=args.seed + i) for i in range(args.jobs)]
+
+    jobs_dir = Path(tempfile.mkdtemp(prefix="lecture_benchmark_jobs_"))
+    app_module = load_app(jobs_dir, args)
+    backend = FakeGeminiBackend(FakeGeminiConfig(
+        upload_latency_s=args.upload_latency, processing_delay_s=args.processing_delay,
+        generate_latency_s=args.generate_latency, generate_latency_per_mb_s=args.generate_latency_per_mb,
+        rate_limit_probability=args.rate_limit_probability, seed=args.seed,
+    ))
+    backend.install(app_module)
+
+    latencies = LatencyLog()
+    sampler = RssSampler()
+    sampler.start()
+    started_at = time.monotonic()
+    print(f"Carico in corso ({args.jobs} job, {args.concurrency} client, {args.job_workers} worker)...")
+    try:
+        with open(args.app_log, "w") as app_log, contextlib.redirect_stdout(app_log):
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                futures = [executor.submit(run_client_job, app_module, i, lectures[i], args, latencies) for i in range(args.jobs)]
+                jobs = [future.result() for future in futures]
+        wall_s = max(job["finished_at"] for job in jobs) - started_at
+    finally:
+        sampler.stop()
+        if not args.keep_jobs_dir:
+            shutil.rmtree(jobs_dir, ignore_errors=True)
+
+    report = build_report(args, jobs, latencies, sampler, backend, wall_s)
+    print_report(report)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"\nRisultato salvato in {args.output}")
+    if args.compare:
+        regressions = compare_reports(report, json.loads(Path(args.compare).read_text()), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Generatore di lezioni sintetiche di durata e formato arbitrari, tramite ffmpeg.
+
+Il segnale imita il parlato: un tono con armoniche modulato in ampiezza a ritmo di sillaba,
+con pause periodiche e rumore di fondo, così che la codifica e la durata dei file siano
+realistiche. Lo stesso insieme di parametri produce sempre lo stesso file.
+
+Uso:
+    python benchmarks/synthetic_lecture.py --duration 5400 --format m4a -o lezione.m4a
+"""
+import argparse
+import hashlib
+import json
+import subprocess
+from pathlib import Path
+
+# Codec e parametri per estensione; "mp4" include una traccia video nera, come una registrazione dello schermo.
+FORMATS = {
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "128k"],
+    "m4a": ["-c:a", "aac", "-b:a", "96k"],
+    "wav": ["-c:a", "pcm_s16le"],
+    "ogg": ["-c:a", "libvorbis", "-q:a", "3"],
+    "webm": ["-c:a", "libopus", "-b:a", "48k"],
+    "mp4": ["-c:a", "aac", "-b:a", "96k", "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage"],
+}
+
+
+def generate_lecture(output_path, duration_s, audio_format="mp3", sample_rate=44100, channels=2, seed=1):
+    """Scrive una lezione sintetica in `output_path` e restituisce il percorso."""
+    if audio_format not in FORMATS:
+        raise ValueError(f"Formato non supportato: {audio_format} (disponibili: {', '.join(FORMATS)})")
+    output_path = Path(output_path)
+    voice = (
+        f"sine=frequency={140 + seed % 60}:sample_rate={sample_rate}:duration={duration_s},"
+        # Armoniche, sillabe (~4 Hz) e una pausa di mezzo secondo ogni 7 secondi.
+        "aeval='val(0)*0.6+0.3*sin(4*PI*t*{f})+0.1*sin(6*PI*t*{f})':c=same,"
+        "volume='(0.55+0.45*sin(2*PI*4*t))*if(lt(mod(t,7),6.5),1,0.05)':eval=frame"
+    ).format(f=140 + seed % 60)
+    noise = f"anoisesrc=color=pink:amplitude=0.03:seed={seed}:sample_rate={sample_rate}:duration={duration_s}"
+    command = [
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", voice,
+        "-f", "lavfi", "-i", noise,
+    ]
+    if audio_format == "mp4":
+        command += ["-f", "lavfi", "-i", f"color=c=black:s=320x240:r=1:d={duration_s}"]
+    command += [
+        "-filter_complex", f"[0:a][1:a]amix=inputs=2:duration=shortest,aformat=channel_layouts={'stereo' if channels == 2 else 'mono'}[a]",
+        "-map", "[a]",
+    ]
+    if audio_format == "mp4":
+        command += ["-map", "2:v", "-shortest"]
+    command += FORMATS[audio_format] + [str(output_path)]
+    subprocess.run(command, check=True)
+    return output_path
+
+
+def cached_lecture(cache_dir, duration_s, audio_format="mp3", sample_rate=44100, channels=2, seed=1):
+    """Come `generate_lecture`, ma riusa il file già generato con gli stessi parametri."""
+    params = {"duration_s": duration_s, "format": audio_format, "sample_rate": sample_rate, "channels": channels, "seed": seed}
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    output_path = cache_dir / f"lecture_{digest}.{audio_format}"
+    if not output_path.exists():
+        partial_path = output_path.with_name(f"partial_{output_path.name}")
+        generate_lecture(partial_path, duration_s, audio_format, sample_rate, channels, seed)
+        partial_path.rename(output_path)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera una lezione sintetica.")
+    parser.add_argument("--duration", type=float, default=3600, help="durata in secondi")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="mp3")
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--channels", type=int, choices=(1, 2), default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+    path = generate_lecture(args.output, args.duration, args.format, args.sample_rate, args.channels, args.seed)
+    print(f"Lezione sintetica scritta in {path} ({path.stat().st_size} byte).")
+
+
+if __name__ == "__main__":
+    main()